@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+
+from bpe_metrics import PeakRSSSampler
+from pretoken_table import BYTE_TOKENS, PreTokenTable
+from pretokenization_example import process_parallel
+from train_bpe import merge_ids
+
+"""
+BPE 训练的 benchmark
+
+对每个语料分别测两个阶段：
+1. 预分词（process_parallel）：吞吐量 MB/s 和峰值内存
+2. 合并（merge_ids）：对每个 vocab_size 测 merges/s 和峰值内存
+
+语料包括 tests/fixtures 里的几个文件和按指定大小生成的合成语料（固定随机种子，每次生成的内容一样）。
+每个阶段先跑 warmup 次（不计入结果），再跑 repeats 次，记录耗时和峰值内存的中位数，单次测量的抖动不会被当成回归。
+每次运行的结果追加到 history 文件里（一个 JSON 列表），并和 baseline 文件比较：
+吞吐量下降或峰值内存上升超过 threshold 就算回归，进程以非零状态退出。
+耗时不到 min_seconds 的阶段（例如几 KB 的 fixture 上的预分词，测到的主要是进程池的启动时间）只记录不比较。
+
+用法：
+    python bpe_benchmark.py --vocab-sizes 500 1000 --synthetic-sizes-mb 1 8
+    python bpe_benchmark.py --update-baseline   # 把这次的结果设为新的 baseline
+    python bpe_benchmark.py --repeats 9 --warmup 2 --min-seconds 2
+"""
+
+SPECIAL_TOKEN = "<|endoftext|>"
+FIXTURES_PATH = Path(__file__).resolve().parent.parent / "tests" / "fixtures"
+FIXTURE_CORPORA = ["corpus.en", "tinystories_sample.txt"]
+DEFAULT_OUTPUT_DIR = Path(__file__).resolve().parent.parent / "data" / "benchmarks"
+DEFAULT_REPEATS = 5
+DEFAULT_WARMUP = 1
+# 中位数耗时比这个短的阶段不参与回归比较
+DEFAULT_MIN_SECONDS = 1.0
+
+
+def make_synthetic_corpus(path:str, size_bytes:int, seed:int=0):
+    """
+    生成一个大约 size_bytes 的合成语料：词从一个固定的词表里按 Zipf 分布抽取，
+    文档之间用 <|endoftext|> 分隔
+    """
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocabulary = ["".join(rng.choice(letters) for _ in range(rng.randint(1, 10))) for _ in range(20000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    punctuation = [".", ",", "!", "?", ""]
+
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < size_bytes:
+            words = rng.choices(vocabulary, weights=weights, k=rng.randint(50, 300))
+            document = " ".join(word + rng.choice(punctuation) for word in words) + "\n" + SPECIAL_TOKEN + "\n"
+            f.write(document)
+            written += len(document)
+
+
+def measure(run_once, repeats:int=DEFAULT_REPEATS, warmup:int=DEFAULT_WARMUP):
+    """
+    先调用 run_once() warmup 次，再调用 repeats 次并分别采样峰值内存。run_once 返回 (结果, 耗时秒数)。
+    返回 (最后一次的结果, 每次的耗时, 峰值内存的中位数)
+    """
+    for _ in range(warmup):
+        run_once()
+    seconds, peaks = [], []
+    for _ in range(max(repeats, 1)):
+        with PeakRSSSampler() as sampler:
+            output, elapsed = run_once()
+        seconds.append(elapsed)
+        peaks.append(sampler.peak_mb)
+    return output, seconds, statistics.median(peaks)
+
+
+def benchmark_corpus(name:str, path:str, vocab_sizes:list[int], num_workers:int|None=None,
+                     repeats:int=DEFAULT_REPEATS, warmup:int=DEFAULT_WARMUP)->list[dict]:
+    """对一个语料分别测预分词和每个 vocab_size 的合并，吞吐量按中位数耗时计算"""
+    results = []
+    size_bytes = os.path.getsize(path)
+
+    pre_token_counts, seconds, peak_rss_mb = measure(
+        lambda: process_parallel(path, num_workers=num_workers), repeats, warmup)
+    elapsed = statistics.median(seconds)
+    results.append({
+        "stage": "pretokenize",
+        "corpus": name,
+        "bytes": size_bytes,
+        "seconds": elapsed,
+        "seconds_per_repeat": seconds,
+        "mb_per_sec": size_bytes / 1024 / 1024 / max(elapsed, 1e-9),
+        "unique_pre_tokens": len(pre_token_counts),
+        "peak_rss_mb": peak_rss_mb,
+    })
+
+    def merge_once(num_merges):
+        # merge_ids 会原地改写 table 和 token_bytes，每次都从头构建
+        token_bytes = list(BYTE_TOKENS) + [SPECIAL_TOKEN.encode("utf-8")]
+        table = PreTokenTable.from_pre_token_counts(pre_token_counts)
+        start = time.perf_counter()
+        merges = merge_ids(num_merges, table, token_bytes)
+        return merges, time.perf_counter() - start
+
+    for vocab_size in vocab_sizes:
+        num_merges = vocab_size - len(BYTE_TOKENS) - 1
+        merges, seconds, peak_rss_mb = measure(partial(merge_once, num_merges), repeats, warmup)
+        elapsed = statistics.median(seconds)
+        results.append({
+            "stage": "merge",
+            "corpus": name,
+            "vocab_size": vocab_size,
+            "merges": len(merges),
+            "seconds": elapsed,
+            "seconds_per_repeat": seconds,
+            "merges_per_sec": len(merges) / max(elapsed, 1e-9),
+            "peak_rss_mb": peak_rss_mb,
+        })
+    return results
+
+
+def run_benchmarks(vocab_sizes:list[int], synthetic_sizes_mb:list[float], num_workers:int|None=None,
+                   seed:int=0, repeats:int=DEFAULT_REPEATS, warmup:int=DEFAULT_WARMUP)->dict:
+    """跑完所有语料，返回一次运行的完整记录"""
+    results = []
+    for corpus in FIXTURE_CORPORA:
+        path = FIXTURES_PATH / corpus
+        if path.exists():
+            results.extend(benchmark_corpus(corpus, str(path), vocab_sizes, num_workers, repeats, warmup))
+
+    with tempfile.TemporaryDirectory(prefix="bpe_benchmark_") as tmp_dir:
+        for size_mb in synthetic_sizes_mb:
+            path = os.path.join(tmp_dir, f"synthetic_{size_mb}mb.txt")
+            make_synthetic_corpus(path, int(size_mb * 1024 * 1024), seed)
+            results.extend(benchmark_corpus(f"synthetic_{size_mb}mb", path, vocab_sizes, num_workers,
+                                            repeats, warmup))
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": current_git_commit(),
+        "cpu_count": os.cpu_count(),
+        "repeats": repeats,
+        "warmup": warmup,
+        "results": results,
+    }
+
+
+def current_git_commit()->str|None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=Path(__file__).resolve().parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result:dict)->tuple:
+    return result["stage"], result["corpus"], result.get("vocab_size")
+
+
+def result_name(result:dict)->str:
+    return "/".join(str(part) for part in result_key(result) if part is not None)
+
+
+def too_short_to_compare(run:dict, baseline:dict, min_seconds:float=DEFAULT_MIN_SECONDS)->list[str]:
+    """这次或 baseline 里中位数耗时不到 min_seconds 的阶段：太短了测不准（例如主要是进程池的启动时间），find_regressions 不比较它们"""
+    baseline_results = {result_key(result): result for result in baseline["results"]}
+    return [result_name(result) for result in run["results"]
+            if result_key(result) in baseline_results
+            and min(result["seconds"], baseline_results[result_key(result)]["seconds"]) < min_seconds]
+
+
+def find_regressions(run:dict, baseline:dict, threshold:float=0.1,
+                     min_seconds:float=DEFAULT_MIN_SECONDS)->list[str]:
+    """
+    和 baseline 比较：吞吐量（mb_per_sec / merges_per_sec）下降超过 threshold，
+    或者峰值内存上升超过 threshold 都算回归。返回每个回归的描述。
+    两边的数字都是多次运行的中位数；任意一边耗时不到 min_seconds 的阶段跳过（见 too_short_to_compare）。
+    """
+    baseline_results = {result_key(result): result for result in baseline["results"]}
+    skipped = set(too_short_to_compare(run, baseline, min_seconds))
+    regressions = []
+    for result in run["results"]:
+        reference = baseline_results.get(result_key(result))
+        name = result_name(result)
+        if reference is None or name in skipped:
+            continue
+        throughput = "mb_per_sec" if result["stage"] == "pretokenize" else "merges_per_sec"
+        if result[throughput] < reference[throughput] * (1 - threshold):
+            regressions.append(f"{name}: {throughput} {result[throughput]:.2f} < baseline {reference[throughput]:.2f}")
+        if result["peak_rss_mb"] > reference["peak_rss_mb"] * (1 + threshold):
+            regressions.append(f"{name}: peak_rss_mb {result['peak_rss_mb']:.1f} > baseline {reference['peak_rss_mb']:.1f}")
+    return regressions
+
+
+def append_history(history_path:Path, run:dict):
+    history = json.loads(history_path.read_text(encoding="utf-8")) if history_path.exists() else []
+    history.append(run)
+    history_path.write_text(json.dumps(history, indent=2), encoding="utf-8")
+
+
+def main(argv:list[str]|None=None)->int:
+    parser = argparse.ArgumentParser(description="Benchmark BPE pretokenization and merging.")
+    parser.add_argument("--vocab-sizes", type=int, nargs="+", default=[500, 1000])
+    parser.add_argument("--synthetic-sizes-mb", type=float, nargs="*", default=[1, 8])
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", type=Path, default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative throughput drop / memory increase counted as a regression")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS,
+                        help="timed runs per stage; the median is recorded and compared")
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP, help="untimed runs per stage before the repeats")
+    parser.add_argument("--min-seconds", type=float, default=DEFAULT_MIN_SECONDS,
+                        help="stages faster than this (median) are recorded but not compared")
+    parser.add_argument("--update-baseline", action="store_true", help="store this run as the new baseline")
+    args = parser.parse_args(argv)
+
+    run = run_benchmarks(args.vocab_sizes, args.synthetic_sizes_mb, args.num_workers, args.seed,
+                         args.repeats, args.warmup)
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    history_path = args.output_dir / "bpe_benchmark_history.json"
+    baseline_path = args.output_dir / "bpe_benchmark_baseline.json"
+    append_history(history_path, run)
+
+    print("\n" + "="*80)
+    print("BPE Benchmark Results")
+    print("="*80)
+    for result in run["results"]:
+        print(json.dumps(result))
+    print(f"Appended results to: {history_path}")
+
+    if args.update_baseline or not baseline_path.exists():
+        baseline_path.write_text(json.dumps(run, indent=2), encoding="utf-8")
+        print(f"Saved baseline to: {baseline_path}")
+        return 0
+
+    baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+    skipped = too_short_to_compare(run, baseline, args.min_seconds)
+    if skipped:
+        print(f"Not compared (faster than {args.min_seconds:.1f} s, too short to time reliably): {', '.join(skipped)}")
+    regressions = find_regressions(run, baseline, args.threshold, args.min_seconds)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) against {baseline_path}:")
+        for regression in regressions:
+            print(f"  - {regression}")
+        return 1
+    print(f"No regressions against {baseline_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+import mmap
+import os
+import sys
+from array import array
+
+"""
+词表和合并表的紧凑二进制格式
+
+JSON 格式（serialize_vocab / serialize_merges）每个 token 都要经过 gpt2_bytes_to_unicode 的映射，
+写出来和读回来都很慢。这里直接存原始字节，加载时只有几次数组拷贝和每个 token 一次切片，没有任何解析。
+读取用的是 mmap，但这只是省掉了先把整个文件 read 进来的那一次拷贝：每个 token 仍然会拷贝成一个独立的 bytes，
+因为返回的 vocab 要在文件关闭之后继续使用，而且 merges 和 tokenizer 需要可哈希的 bytes，不能是映射上的 view。
+JSON 导出仍然保留，用于和其他工具互通。
+
+文件格式（小端序）：
+    magic        8 字节  b"CS336BPE"
+    version      uint32
+    num_vocab    uint32
+    num_merges   uint32
+    ids          num_vocab 个 uint32      token id
+    lengths      num_vocab 个 uint32      每个 token 的字节数
+    merges       2 * num_merges 个 uint32  每个 merge 的 (左 token id, 右 token id)
+    blob         所有 token 的字节按 ids 的顺序首尾相接
+"""
+
+BPE_BINARY_MAGIC = b"CS336BPE"
+BPE_BINARY_VERSION = 1
+HEADER_SIZE = len(BPE_BINARY_MAGIC) + 4 * 3
+
+
+def to_little_endian(arr:array)->array:
+    """在大端机器上原地转换字节序（两个方向都一样），这里的二进制格式都是小端序"""
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr
+
+
+def save_bpe_binary(path:str, vocab:dict[int, bytes], merges:list[tuple[bytes, bytes]]):
+    """Write vocab and merges in the binary format described above."""
+    ids = array('I', vocab.keys())
+    tokens = list(vocab.values())
+    lengths = array('I', map(len, tokens))
+
+    # merges 里的 token 一定在 vocab 里，用 id 表示
+    token_to_id = {}
+    for token_id, token in vocab.items():
+        token_to_id.setdefault(token, token_id)
+    merge_ids = array('I', [token_to_id[token] for pair in merges for token in pair])
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(BPE_BINARY_MAGIC)
+        f.write(b"".join(value.to_bytes(4, "little") for value in (BPE_BINARY_VERSION, len(ids), len(merges))))
+        for arr in (ids, lengths, merge_ids):
+            to_little_endian(arr).tofile(f)
+        f.write(b"".join(tokens))
+    os.replace(tmp_path, path)
+
+
+def load_bpe_binary(path:str)->tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
+    """Load (vocab, merges) written by save_bpe_binary. Tokens are copied out of the mapping into bytes objects."""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:len(BPE_BINARY_MAGIC)] != BPE_BINARY_MAGIC:
+            raise ValueError(f"{path} is not a CS336 BPE binary file")
+        version, num_vocab, num_merges = (
+            int.from_bytes(mm[offset:offset + 4], "little") for offset in range(len(BPE_BINARY_MAGIC), HEADER_SIZE, 4))
+        if version != BPE_BINARY_VERSION:
+            raise ValueError(f"Unsupported BPE binary version {version} in {path}")
+
+        arrays = []
+        offset = HEADER_SIZE
+        for count in (num_vocab, num_vocab, 2 * num_merges):
+            arr = array('I')
+            arr.frombytes(mm[offset:offset + 4 * count])
+            arrays.append(to_little_endian(arr))
+            offset += 4 * count
+        ids, lengths, merge_ids = arrays
+
+        vocab = {}
+        for token_id, length in zip(ids, lengths):
+            # mmap 的切片返回新的 bytes，文件关闭后仍然有效
+            vocab[token_id] = mm[offset:offset + length]
+            offset += length
+
+    merges = [(vocab[left], vocab[right]) for left, right in zip(merge_ids[::2], merge_ids[1::2])]
+    return vocab, merges
@@ -0,0 +1,135 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Self
+
+import psutil
+
+"""
+BPE 训练的结构化指标
+
+merge_ids 每隔 metrics_interval 次合并会调用一次 metrics_callback(record)，record 是一个 dict：
+    merges                  已完成的合并次数
+    total_merges            需要的合并次数
+    elapsed_sec             从开始合并到现在的时间
+    merges_per_sec          最近一个区间的合并速度
+    heap_size               堆里的条目数（包括失效的）
+    live_pairs              merge_tables 里当前有效的 pair 数
+    heap_rebuilds           到目前为止堆被压缩重建的次数
+    stale_ratio             最近一个区间里弹出的堆条目中失效条目的比例
+    words_touched_per_merge 最近一个区间里平均每次合并改写的词数
+    rss_mb                  当前进程的 RSS
+
+JsonlMetricsWriter 把这些记录一行一个 JSON 写到文件里，方便接到 dashboard 上。
+PeakRSSSampler 在后台线程里采样 RSS，用于测量一段代码的峰值内存。
+PhaseTimer 按阶段累计耗时（边界查找、regex、归约、字节转换、合并、序列化……）。
+"""
+
+
+def rss_mb()->float:
+    """当前进程的 RSS（MB）"""
+    return psutil.Process(os.getpid()).memory_info().rss / 1024 / 1024
+
+
+class JsonlMetricsWriter:
+    """Metrics callback that appends every record as one JSON line to path (or stderr if path is None)."""
+
+    def __init__(self, path:str|None=None, **static_fields):
+        self.path = path
+        # 每条记录都会带上的固定字段，例如 run 名字、语料名
+        self.static_fields = static_fields
+
+    def __call__(self, record:dict):
+        line = json.dumps({"time": time.time(), **self.static_fields, **record}, ensure_ascii=False)
+        if self.path is None:
+            print(line, file=sys.stderr, flush=True)
+        else:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class PeakRSSSampler:
+    """
+    后台线程定期采样 RSS，得到真正的峰值内存（包括所有子进程，例如预分词的 worker）。
+    只在开始和结束各读一次 RSS 会错过中间的峰值。
+
+    用法：
+        with PeakRSSSampler() as sampler:
+            ...
+        print(sampler.peak_mb)
+    """
+
+    def __init__(self, interval:float=0.05, include_children:bool=True):
+        self.interval = interval
+        self.include_children = include_children
+        self.peak_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self)->float:
+        process = psutil.Process(os.getpid())
+        total = process.memory_info().rss
+        if self.include_children:
+            for child in process.children(recursive=True):
+                try:
+                    total += child.memory_info().rss
+                except psutil.Error:
+                    # 子进程可能在采样过程中退出
+                    pass
+        current_mb = total / 1024 / 1024
+        self.peak_mb = max(self.peak_mb, current_mb)
+        return current_mb
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self)->Self:
+        self.sample()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="PeakRSSSampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+class PhaseTimer:
+    """
+    按阶段名累计耗时。同一个阶段可以计时多次，结果会累加。
+    阶段可以嵌套：内层阶段的时间只算在内层，外层阶段会扣掉这部分（例如合并过程中保存中间词表的时间算作
+    serialization，不算作 merging），所以各个阶段加起来不会重复计算。
+
+    用法：
+        phases = PhaseTimer()
+        with phases.phase("merging"):
+            ...
+        phases.add("regex", elapsed)
+        print(phases.seconds)
+    """
+
+    def __init__(self):
+        self.seconds: dict[str, float] = {}
+        # 正在计时的阶段里，已经被内层阶段占用的时间
+        self._nested_seconds: list[float] = []
+
+    def add(self, name:str, seconds:float):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name:str):
+        start = time.perf_counter()
+        self._nested_seconds.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.add(name, elapsed - self._nested_seconds.pop())
+            if self._nested_seconds:
+                self._nested_seconds[-1] += elapsed
@@ -0,0 +1,134 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+
+import submitit
+from bpe_metrics import PhaseTimer
+from pretokenization_example import (
+    DEFAULT_CHUNK_SIZE,
+    SPLIT_SPECIAL_TOKENS,
+    plan_byte_ranges,
+    process_single_chunk,
+    reduce_shard,
+    resolve_input_paths,
+    resolve_shard_weights,
+    round_weighted_counts,
+    write_count_shards,
+)
+from pretokenizer import Pretokenizer
+
+"""
+用 submitit 在集群上做 map-reduce 预分词
+
+process_parallel 只能用一台机器上的 multiprocessing.Pool。这里把一个或多个文件切成字节范围（plan_byte_ranges），
+每 ranges_per_job 个范围打包成一个 submitit 任务：
+1. map：每个任务统计自己的字节范围（任务内部可以再用 workers_per_job 个进程），
+   然后按词哈希分成 reduce_shards 份写到共享目录里，只返回文件路径
+2. reduce：每个分区再提交一个任务，把所有 map 任务的同一个分区加起来；分区之间的词互不重叠，最后直接拼接
+reduce_shards=0 时 map 任务直接返回计数，在提交的进程里合并（语料不大时更简单）。
+
+executor 可以是任何 submitit executor：
+- make_executor(folder, cluster="slurm", ...)  提交到 SLURM
+- make_executor(folder, cluster="local")       在本机起子进程跑，单机和测试用
+- make_executor(folder, cluster="debug")       在当前进程里顺序执行，方便调试
+中间结果写在 work_dir（默认是 executor 的 folder）下，必须是所有节点都能访问的共享目录。
+"""
+
+
+def make_executor(folder:str, cluster:str|None=None, timeout_min:int=60, cpus_per_task:int=1,
+                  **parameters)->submitit.AutoExecutor:
+    """
+    创建 submitit executor。cluster 为 None 时自动选择（有 SLURM 就用 SLURM，否则本地）。
+    其余参数直接传给 update_parameters，例如 mem_gb=32 或 slurm_partition="cpu"。
+    """
+    executor = submitit.AutoExecutor(folder=folder, cluster=cluster)
+    executor.update_parameters(timeout_min=timeout_min, cpus_per_task=cpus_per_task, **parameters)
+    return executor
+
+
+def count_ranges_job(ranges:list[tuple[str, int, int, float]], pretokenizer:Pretokenizer, use_mmap:bool, job_id:int,
+                     num_shards:int, shard_dir:str, workers_per_job:int=1):
+    """
+    一个 map 任务：统计若干个 (file_path, start, end, weight) 字节范围。
+    num_shards > 0 时把结果分区写到 shard_dir，返回分区文件路径；否则直接返回计数。
+    """
+    tasks = [(file_path, start, end, pretokenizer, use_mmap, weight) for file_path, start, end, weight in ranges]
+    # 压缩文件是整个文件一个范围，由这个任务自己流式解压
+    counts = Counter()
+    if workers_per_job > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(processes=min(workers_per_job, len(tasks))) as pool:
+            for result in pool.imap_unordered(process_single_chunk, tasks, chunksize=1):
+                counts.update(result)
+    else:
+        for task in tasks:
+            counts.update(process_single_chunk(task))
+
+    if num_shards > 0:
+        return write_count_shards(counts, job_id, num_shards, shard_dir)
+    return dict(counts)
+
+
+def pretokenize_distributed(input_paths:str|list[str], executor:submitit.Executor, work_dir:str|None=None,
+                            ranges_per_job:int=8, chunk_size:int=DEFAULT_CHUNK_SIZE, reduce_shards:int=0,
+                            use_mmap:bool=False, workers_per_job:int=1, phase_timer:PhaseTimer|None=None,
+                            shard_weights:dict[str, float]|None=None)->dict[bytes, int]:
+    """
+    用 executor 对一个或多个文件做 map-reduce 预分词，返回 {预分词字节: 词频}，和 process_parallel 的结果完全一致。
+    input_paths 和 shard_weights 的写法和 process_parallel 一样（文件、glob 模式或列表）。
+    ranges_per_job: 每个 map 任务处理多少个字节范围（每个范围约 chunk_size 字节）
+    reduce_shards: 大于 0 时用这么多个 reduce 任务并行合并
+    workers_per_job: 每个 map 任务内部的进程数，一般和 executor 的 cpus_per_task 一致
+    phase_timer: 如果传入，耗时记到 boundary_search / regex / reduction 三个阶段
+    """
+    input_paths = resolve_input_paths(input_paths)
+    weights = resolve_shard_weights(input_paths, shard_weights)
+    phase_timer = phase_timer or PhaseTimer()
+
+    with phase_timer.phase("boundary_search"):
+        ranges = [(path, start, end, weights[path])
+                  for path, start, end in plan_byte_ranges(input_paths, chunk_size, use_mmap=use_mmap)
+                  if weights[path] != 0]
+    batches = [ranges[i:i + ranges_per_job] for i in range(0, len(ranges), ranges_per_job)]
+    print(f"Submitting {len(batches)} pretokenization jobs for {len(ranges)} byte ranges "
+          f"in {len(input_paths)} file(s)", flush=True)
+
+    pretokenizer = Pretokenizer(SPLIT_SPECIAL_TOKENS)
+    work_dir = os.fspath(work_dir or executor.folder)
+    os.makedirs(work_dir, exist_ok=True)
+    shard_dir = tempfile.mkdtemp(prefix="pretokenize_shards_", dir=work_dir)
+    total_counts = Counter()
+    try:
+        map_start = time.perf_counter()
+        num_jobs = len(batches)
+        jobs = executor.map_array(count_ranges_job, batches, [pretokenizer] * num_jobs, [use_mmap] * num_jobs,
+                                  range(num_jobs), [reduce_shards] * num_jobs, [shard_dir] * num_jobs,
+                                  [workers_per_job] * num_jobs)
+        if reduce_shards > 0:
+            shard_paths = [[] for _ in range(reduce_shards)]
+            for job in jobs:
+                for shard_id, path in enumerate(job.result()):
+                    shard_paths[shard_id].append(path)
+            phase_timer.add("regex", time.perf_counter() - map_start)
+
+            # reduce：每个分区一个任务，分区之间的词互不重叠，直接拼接
+            with phase_timer.phase("reduction"):
+                for job in executor.map_array(reduce_shard, shard_paths):
+                    dict.update(total_counts, job.result())
+        else:
+            reduce_time = 0.0
+            for job in jobs:
+                result = job.result()
+                update_start = time.perf_counter()
+                total_counts.update(result)
+                reduce_time += time.perf_counter() - update_start
+            phase_timer.add("regex", time.perf_counter() - map_start - reduce_time)
+            phase_timer.add("reduction", reduce_time)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+    if any(weight != 1 for weight in weights.values()):
+        return round_weighted_counts(total_counts)
+    return total_counts
@@ -0,0 +1,113 @@
+import multiprocessing
+
+from pretoken_table import PreTokenTable
+from train_bpe import apply_merge, index_word_pairs
+
+"""
+多进程的 BPE 合并
+
+merge_ids 每次合并的大部分时间花在改写包含被合并 pair 的词上，这部分在不同的词之间是独立的。
+这里把词表按下标轮流分给 num_shards 个常驻的 worker 进程（第 i 个词在第 i % num_shards 个分片里），
+每个 worker 持有自己分片的 PreTokenTable 和倒排索引：
+1. 初始化：每个 worker 统计自己分片的相邻对频率，协调进程（merge_ids）把它们加起来得到 merge_tables
+2. 每次合并：协调进程照常从堆里选出要合并的 pair，把 (pair key, 新 token id) 发给所有 worker；
+   每个 worker 改写自己的词（apply_merge），返回 {pair key: 频率变化}，协调进程加起来更新 merge_tables 和堆
+3. checkpoint 和结束时把各个分片按原来的顺序拼回一个 PreTokenTable
+
+选择哪个 pair 只看 merge_tables，而频率变化的总和和单进程时完全一样，所以 merges 和单进程的结果完全一致。
+每次合并都要和所有 worker 通信一次，只有每次合并要改写的词足够多时（大语料、前面的 merges）才划算。
+"""
+
+
+def shard_worker(conn, table:PreTokenTable):
+    """worker 进程的主循环：在自己的分片上执行协调进程发来的命令，直到收到 stop"""
+    pair_to_words = None
+    while True:
+        command, payload = conn.recv()
+        if command == "index":
+            pair_counts, pair_to_words = index_word_pairs(table, payload)
+            conn.send(pair_counts)
+        elif command == "merge":
+            conn.send(apply_merge(table, pair_to_words, *payload))
+        elif command == "table":
+            conn.send(table)
+        elif command == "stop":
+            break
+    conn.close()
+
+
+def split_table(table:PreTokenTable, num_shards:int)->list[PreTokenTable]:
+    """第 i 个词放进第 i % num_shards 个分片，高频词和长词在各个分片里分布得比较均匀"""
+    shards = [PreTokenTable() for _ in range(num_shards)]
+    counts = table.counts
+    for word_index in range(len(table)):
+        shards[word_index % num_shards].append(table.word(word_index), counts[word_index])
+    return shards
+
+
+def sum_pair_deltas(results:list[dict[int, int]])->dict[int, int]:
+    """把各个分片的 {pair key: 频率变化} 加起来，去掉和为 0 的项"""
+    if not results:
+        return {}
+    total = dict(results[0])
+    for deltas in results[1:]:
+        for key, delta in deltas.items():
+            total[key] = total.get(key, 0) + delta
+    return {key: delta for key, delta in total.items() if delta != 0}
+
+
+class ShardedWordTables:
+    """Word table split across worker processes; merge_ids drives it in place of a local table (see merge_workers)."""
+
+    def __init__(self, table:PreTokenTable, num_shards:int):
+        self.num_shards = num_shards
+        self.connections = []
+        self.processes = []
+        for shard in split_table(table, num_shards):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=shard_worker, args=(child_conn, shard), daemon=True)
+            process.start()
+            child_conn.close()
+            self.connections.append(parent_conn)
+            self.processes.append(process)
+
+    def _broadcast(self, command:str, payload=None)->list:
+        # 先发给所有 worker 再依次收结果，worker 之间并行执行
+        for conn in self.connections:
+            conn.send((command, payload))
+        return [conn.recv() for conn in self.connections]
+
+    def index_pairs(self, count_pairs:bool=True)->dict[int, int]|None:
+        """在每个分片上建立倒排索引；count_pairs 时返回所有分片加起来的相邻对频率"""
+        results = self._broadcast("index", count_pairs)
+        return sum_pair_deltas(results) if count_pairs else None
+
+    def apply_merge(self, pair_key:int, new_id:int)->tuple[dict[int, int], int]:
+        """和 train_bpe.apply_merge 一样，返回所有分片加起来的 (频率变化, 改写的词数)"""
+        results = self._broadcast("merge", (pair_key, new_id))
+        return sum_pair_deltas([deltas for deltas, _ in results]), sum(words for _, words in results)
+
+    def gather(self, table:PreTokenTable):
+        """把各个分片当前的词按原来的顺序写回 table（整体替换它的数组，多余的空位也顺便去掉）"""
+        shards = self._broadcast("table")
+        gathered = PreTokenTable()
+        for word_index in range(sum(len(shard) for shard in shards)):
+            shard = shards[word_index % self.num_shards]
+            local_index = word_index // self.num_shards
+            gathered.append(shard.word(local_index), shard.counts[local_index])
+        table.symbols, table.offsets, table.lengths, table.counts = (
+            gathered.symbols, gathered.offsets, gathered.lengths, gathered.counts)
+
+    def close(self):
+        for conn, process in zip(self.connections, self.processes):
+            if process.is_alive():
+                try:
+                    conn.send(("stop", None))
+                except (BrokenPipeError, OSError):
+                    pass
+            conn.close()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
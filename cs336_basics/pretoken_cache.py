@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+from array import array
+
+from bpe_binary import to_little_endian
+from pretokenization_example import SPLIT_SPECIAL_TOKENS, resolve_input_paths, resolve_shard_weights
+from pretokenizer import PAT
+
+"""
+预分词结果的磁盘缓存
+
+同一个文件只改 vocab_size 或 special tokens 时，预分词的结果完全一样，没必要每次都重新跑 process_parallel。
+这里把 {预分词的 UTF-8 字节: 词频} 存成一个紧凑的二进制文件，文件名由下面这些信息的哈希决定：
+- 输入文件的身份：大小、mtime、文件头/中间/尾部各 1 MB 内容的哈希（对几十 GB 的文件做全量哈希太慢）；
+  多个分片时是每个文件的路径、身份和权重
+- 预分词正则 PAT
+- 切分文档用的 special tokens
+- 其他会影响结果的选项（例如抽样的大小和种子）
+- 缓存格式版本
+任何一项变了都会得到一个新的 key，旧的缓存文件不会被误用。
+
+文件格式（小端序）：
+    magic       8 字节  b"CS336PTC"
+    version     uint32
+    num_words   uint64
+    counts      num_words 个 uint64
+    lengths     num_words 个 uint32（每个词的字节数）
+    words       所有词的 UTF-8 字节首尾相接
+"""
+
+CACHE_MAGIC = b"CS336PTC"
+CACHE_VERSION = 1
+SAMPLE_SIZE = 1024 * 1024
+
+# 默认的缓存目录，可以用环境变量配置；为空时不使用缓存
+# 缓存在库里是需要打开的（opt-in）：默认打开的话，同一个文件第二次训练时就不会再走进程池 / submitit / mmap 这些
+# 预分词路径，测试和 benchmark 会悄悄地只测到读缓存，而且每次训练都会往磁盘上写文件。
+# train_tinystories_bpe 默认把缓存放在 data/pretoken_cache，扫 vocab_size 时自动复用
+CACHE_DIR_ENV = "CS336_PRETOKEN_CACHE_DIR"
+
+
+def default_cache_dir()->str|None:
+    """$CS336_PRETOKEN_CACHE_DIR，没有设置时返回 None（不使用缓存）"""
+    return os.environ.get(CACHE_DIR_ENV) or None
+
+
+def file_fingerprint(path:str)->dict:
+    """文件大小、mtime 和采样内容哈希"""
+    stat = os.stat(path)
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for offset in sorted({0, max(stat.st_size // 2 - SAMPLE_SIZE // 2, 0), max(stat.st_size - SAMPLE_SIZE, 0)}):
+            f.seek(offset)
+            hasher.update(f.read(SAMPLE_SIZE))
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sample_hash": hasher.hexdigest()}
+
+
+def pretoken_cache_key(input_path:str|list[str], pattern:str=PAT, special_tokens:list[str]=SPLIT_SPECIAL_TOKENS,
+                       shard_weights:dict[str, float]|None=None, options:dict|None=None)->str:
+    """Content-addressed key for the pretokenization result of input_path (a file, glob or list of them)."""
+    file_paths = resolve_input_paths(input_path)
+    identity = {
+        "version": CACHE_VERSION,
+        "pattern": pattern,
+        "special_tokens": list(special_tokens),
+    }
+    if len(file_paths) == 1 and not shard_weights:
+        identity["file"] = file_fingerprint(file_paths[0])
+    else:
+        weights = resolve_shard_weights(file_paths, shard_weights)
+        identity["files"] = [[path, file_fingerprint(path), weights[path]] for path in file_paths]
+    if options:
+        identity["options"] = options
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def save_pre_token_counts(path:str, pre_token_counts:dict[bytes, int]):
+    """把 {预分词字节: 词频} 写成上面描述的二进制格式（先写临时文件再 rename）"""
+    encoded = list(pre_token_counts)
+    counts = to_little_endian(array('Q', pre_token_counts.values()))
+    lengths = to_little_endian(array('I', map(len, encoded)))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(CACHE_MAGIC)
+        f.write(CACHE_VERSION.to_bytes(4, "little"))
+        f.write(len(encoded).to_bytes(8, "little"))
+        counts.tofile(f)
+        lengths.tofile(f)
+        f.write(b"".join(encoded))
+    os.replace(tmp_path, path)
+
+
+def load_pre_token_counts(path:str)->dict[bytes, int]:
+    """读取 save_pre_token_counts 写出的文件"""
+    with open(path, "rb") as f:
+        if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            raise ValueError(f"{path} is not a pre-token count file")
+        version = int.from_bytes(f.read(4), "little")
+        if version != CACHE_VERSION:
+            raise ValueError(f"Unsupported pre-token count file version {version} in {path}")
+        num_words = int.from_bytes(f.read(8), "little")
+        counts = array('Q')
+        counts.fromfile(f, num_words)
+        lengths = array('I')
+        lengths.fromfile(f, num_words)
+        blob = f.read()
+    to_little_endian(counts)
+    to_little_endian(lengths)
+
+    pre_token_counts = {}
+    offset = 0
+    for length, count in zip(lengths, counts):
+        pre_token_counts[blob[offset:offset + length]] = count
+        offset += length
+    return pre_token_counts
+
+
+def merge_pre_token_counts(base:dict[bytes, int], delta:dict[bytes, int])->dict[bytes, int]:
+    """把新增语料的词频加到已有的词频上（增量训练用）。会直接修改并返回较大的那个 dict"""
+    if len(base) < len(delta):
+        base, delta = delta, base
+    for word, count in delta.items():
+        base[word] = base.get(word, 0) + count
+    return base
+
+
+def cached_pretokenize(input_path:str|list[str], cache_dir:str|None, pretokenize,
+                       shard_weights:dict[str, float]|None=None, options:dict|None=None)->dict[bytes, int]:
+    """
+    如果 cache_dir 里有 input_path 对应的缓存就直接读取，否则调用 pretokenize(input_path) 并写入缓存。
+    cache_dir 为 None 时直接调用 pretokenize。shard_weights 和 options 会影响结果，所以也是缓存 key 的一部分。
+    """
+    if not cache_dir:
+        return pretokenize(input_path)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, f"{pretoken_cache_key(input_path, shard_weights=shard_weights, options=options)}.ptc")
+    if os.path.exists(cache_path):
+        print(f"Loading cached pre-token counts from: {cache_path}", flush=True)
+        return load_pre_token_counts(cache_path)
+
+    pre_token_counts = pretokenize(input_path)
+    save_pre_token_counts(cache_path, pre_token_counts)
+    print(f"Saved pre-token counts cache to: {cache_path}", flush=True)
+    return pre_token_counts
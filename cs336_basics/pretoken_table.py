@@ -0,0 +1,71 @@
+from array import array
+
+# 256 个单字节 token，所有地方共用这一份，不用每次 bytes([i]) 重新创建
+BYTE_TOKENS = tuple(bytes([i]) for i in range(256))
+
+"""
+预分词表的紧凑存储（CSR 格式）
+
+原来每个预分词词是一个 tuple(bytes([b]) for b in word)，每个字节都是一个独立的 Python 对象，
+再加上 tuple 本身的开销，一个 5 个字节的词要占几百字节。这里把所有词拼接到一个连续的整数数组里：
+
+symbols: 所有词的 token id 首尾相接，array('I')，每个 token 4 字节
+offsets: 第 i 个词在 symbols 中的起始位置
+lengths: 第 i 个词当前的长度（合并后会变短，变短后多出来的位置直接留空，不搬移数据）
+counts:  第 i 个词的词频
+
+例子：pre_token_counts = {b"hello": 2, b" cat": 3}
+symbols = [104, 101, 108, 108, 111, 32, 99, 97, 116]
+offsets = [0, 5]
+lengths = [5, 4]
+counts  = [2, 3]
+
+合并 (l, l) -> 300 之后，第 0 个词原地改写：
+symbols = [104, 101, 300, 111, 111, 32, 99, 97, 116]   # 第 4 个位置已经不属于任何词
+lengths = [4, 4]
+"""
+
+
+class PreTokenTable:
+    """Flat array-backed table of pre-token words (token id sequences) and their counts."""
+
+    def __init__(self):
+        self.symbols = array('I')
+        self.offsets = array('Q')
+        self.lengths = array('I')
+        self.counts = array('Q')
+
+    @classmethod
+    def from_pre_token_counts(cls, pre_token_counts:dict[bytes, int])->"PreTokenTable":
+        """从 {预分词的 UTF-8 字节: 词频} 构建，每个字节的 token id 就是字节值本身"""
+        table = cls()
+        for word, count in pre_token_counts.items():
+            table.append(word, count)
+        return table
+
+    def append(self, word_ids, count:int):
+        """追加一个词，word_ids 可以是 bytes（每个字节就是一个 id）或任意 int 序列"""
+        self.offsets.append(len(self.symbols))
+        self.lengths.append(len(word_ids))
+        self.counts.append(count)
+        self.symbols.extend(word_ids)
+
+    def __len__(self)->int:
+        return len(self.counts)
+
+    def word(self, index:int)->array:
+        """返回第 index 个词当前的 token id（拷贝出来的小数组）"""
+        start = self.offsets[index]
+        return self.symbols[start:start + self.lengths[index]]
+
+    def set_word(self, index:int, new_word:list[int]):
+        """原地改写第 index 个词，新词不能比原来的长（BPE 合并只会让词变短）"""
+        start = self.offsets[index]
+        new_len = len(new_word)
+        assert new_len <= self.lengths[index], "merged word can not grow"
+        self.symbols[start:start + new_len] = array('I', new_word)
+        self.lengths[index] = new_len
+
+    def nbytes(self)->int:
+        """四个数组一共占用的字节数"""
+        return sum(arr.itemsize * len(arr) for arr in (self.symbols, self.offsets, self.lengths, self.counts))
@@ -1,10 +1,24 @@
+import bz2
+import fnmatch
+import glob
+import gzip
+import itertools
+import lzma
+import mmap
 import multiprocessing
 import os
+import pickle
+import queue
+import random
+import tempfile
+import zlib
+from array import array
 from typing import BinaryIO
 import time
 from functools import wraps
-import regex as re
 from collections import Counter
+from bpe_metrics import PhaseTimer
+from pretokenizer import Pretokenizer
 
 """
 
@@ -101,6 +115,29 @@ def find_chunk_boundaries(
     return sorted(set(chunk_boundaries))
 
 
+def find_chunk_boundaries_mmap(
+    mm: mmap.mmap,
+    desired_num_chunks: int,
+    split_special_token: bytes,
+) -> list[int]:
+    """
+    find_chunk_boundaries 的 mmap 版本：直接在映射上用 mm.find 查找 special token，
+    不需要循环 seek + read 4KB 的小块，也不会漏掉横跨两个小块的 special token。
+    """
+    assert isinstance(split_special_token, bytes), "Must represent special token as a bytestring"
+
+    file_size = len(mm)
+    chunk_size = file_size // desired_num_chunks
+    chunk_boundaries = [i * chunk_size for i in range(desired_num_chunks + 1)]
+    chunk_boundaries[-1] = file_size
+
+    for bi in range(1, len(chunk_boundaries) - 1):
+        found_at = mm.find(split_special_token, chunk_boundaries[bi])
+        chunk_boundaries[bi] = file_size if found_at == -1 else found_at
+
+    return sorted(set(chunk_boundaries))
+
+
 ## Usage
 # 获取边界列表后，遍历边界列表，读取每个chunk并解码为文本
 r"""
@@ -113,94 +150,571 @@ r"""
 re.escape 的作用：转义正则特殊字符，让它们被当作普通文本匹配。
 在正则表达式中，| 的优先级很高，它会先被解释为"或"运算符，而不是文本字符。
 
+上面这些现在都在 pretokenizer.Pretokenizer 里：正则只在构造时编译一次，训练和编码共用同一个实现。
 """
 
 
+# 预分词时用来切分文档的 special token（和训练时加进词表的 special tokens 无关）
+SPLIT_SPECIAL_TOKENS = ["<|endoftext|>"]
+
+# 不带 special token 的预分词器，count_pre_tokens 用
+DEFAULT_PRETOKENIZER = Pretokenizer()
+
+
 def count_pre_tokens(chunk:str)->dict[str, int]:
     """
     Count the number of pre-tokens in the chunk.
     """
-    PAT = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+    return DEFAULT_PRETOKENIZER.count(chunk)
 
+# 流式读取时每个窗口的大小。每个 worker 同一时间只持有一个窗口（加上窗口末尾未完成的文档），
+# 所以内存占用和文件大小、chunk 大小都无关
+DEFAULT_WINDOW_SIZE = 16 * 1024 * 1024
+# 未完成的文档超过这么多个窗口时（special token 很少或者没有），不再等 special token，在一个安全的空格处强制切开
+MAX_CARRY_WINDOWS = 4
+# 正则里的 \s 在 ASCII 范围内包含的字符
+ASCII_WHITESPACE = b" \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f"
 
-    from collections import Counter
 
+def find_safe_cut(buffer, start:int, end:int)->int:
+    """
+    在 buffer[start:end] 里从后往前找一个可以切开而不改变预分词结果的位置，找不到返回 -1。
+    选的是前一个字节是 ASCII 非空白字符的空格：PAT 里含非空白字符的预分词都不会把后面的空白吞进去，
+    所以这里一定是两个预分词的边界，而 PAT 没有向后看的断言，从这里开始匹配和在整段文本里匹配完全一样。
+    空格是 ASCII，也不会切开多字节的 UTF-8 字符（非法字节在 "ignore" 解码时也不受影响）。
+    """
+    pos = buffer.rfind(b" ", max(start, 1), end)
+    while pos != -1:
+        prev = buffer[pos - 1]
+        if prev < 0x80 and prev not in ASCII_WHITESPACE:
+            return pos
+        pos = buffer.rfind(b" ", max(start, 1), pos)
+    return -1
 
-    words = re.findall(PAT, chunk)
-    frequency = Counter(words)
-    return frequency
 
-def process_chunk_with_file(f, start, end, special_tokens):
-    """处理单个 chunk，使用已打开的文件对象（串行和并行都可以用）"""
-    f.seek(start)
-    chunk = f.read(end - start).decode("utf-8", errors="ignore")
-    
-    # 处理 special tokens
-    escaped_tokens = [re.escape(token) for token in special_tokens]
-    pattern = r"|".join(escaped_tokens)
-    chunks = re.split(pattern, chunk)
-    
-    # 统计这个 chunk 的所有预分词
-    from collections import Counter
+def iter_chunk_windows(f, start, end, split_special_token:bytes, window_size:int=DEFAULT_WINDOW_SIZE):
+    """
+    把 [start, end) 切成若干个窗口依次读取，每个窗口都在 split_special_token 的起始位置切开。
+    end 为 None 时一直读到文件末尾（压缩文件不知道解压后的大小，也不能 seek，只能从头流式读取）。
+    因为之后本来就要在 special token 处 split，所以在这里切开不会改变预分词结果；
+    special token 是 ASCII，也不会把一个多字节的 UTF-8 字符切成两半。
+    如果一个窗口里找不到 special token（单个文档比窗口还长），就继续往后读；未完成的部分超过
+    MAX_CARRY_WINDOWS 个窗口后在安全的空格处切开（见 find_safe_cut），所以每个 worker 的内存有上界。
+    每次只在新读入的数据里找，整个 chunk 的扫描和拷贝都是线性的。
+    """
+    if start:
+        f.seek(start)
+    remaining = None if end is None else end - start
+    max_carry = MAX_CARRY_WINDOWS * window_size
+    buffer = bytearray()
+    while remaining is None or remaining > 0:
+        data = f.read(window_size if remaining is None else min(window_size, remaining))
+        if not data:
+            break
+        if remaining is not None:
+            remaining -= len(data)
+        scanned = len(buffer)
+        buffer += data
+        # 从后往前找最后一个 special token，之前的部分可以安全地处理掉。
+        # buffer 里之前的部分已经找过了（只有开头可能是 special token），只需要从可能跨两次读取的位置开始找
+        cut = buffer.rfind(split_special_token, max(scanned - len(split_special_token) + 1, 0))
+        if cut <= 0 and len(buffer) > max_carry:
+            cut = find_safe_cut(buffer, scanned, len(buffer))
+        if cut > 0:
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
+    if buffer:
+        yield bytes(buffer)
+
+
+def iter_mmap_windows(mm:mmap.mmap, start, end, split_special_token:bytes, window_size:int=DEFAULT_WINDOW_SIZE):
+    """
+    iter_chunk_windows 的 mmap 版本：切分规则一样（窗口在 special token 处切开，太长时在安全的空格处切开），
+    但返回的是映射上的 memoryview，不拷贝数据
+    """
+    view = memoryview(mm)
+    max_carry = MAX_CARRY_WINDOWS * window_size
+    try:
+        pos = start
+        while pos < end:
+            target = pos + window_size
+            if target >= end:
+                cut = end
+            else:
+                # 窗口内最后一个 special token；没有的话往后找下一个，但最多找到 max_carry
+                cut = mm.rfind(split_special_token, pos + 1, target)
+                if cut == -1:
+                    limit = min(pos + max_carry, end)
+                    cut = mm.find(split_special_token, target, limit)
+                    if cut == -1 and limit < end:
+                        cut = find_safe_cut(mm, target, limit)
+                    if cut == -1:
+                        cut = mm.find(split_special_token, limit, end)
+                    if cut == -1:
+                        cut = end
+            yield view[pos:cut]
+            pos = cut
+    finally:
+        view.release()
+
+
+def count_windows(windows, pretokenizer:Pretokenizer)->dict[bytes, int]:
+    """统计若干窗口（bytes 或 memoryview）里的所有预分词，key 是预分词的 UTF-8 字节"""
     chunk_counts = Counter()
-    for chunk in chunks:
-        counts = count_pre_tokens(chunk)
-        chunk_counts.update(counts)
+    for window in windows:
+        # str(..., "utf-8", "ignore") 对 bytes 和 memoryview 都适用，memoryview 直接从映射解码
+        text = str(window, "utf-8", "ignore")
+        chunk_counts.update(pretokenizer.count_bytes(text))
+        del text
+        if isinstance(window, memoryview):
+            window.release()
     return dict(chunk_counts)
 
 
+def process_chunk_with_file(f, start, end, pretokenizer:Pretokenizer, window_size:int|None=DEFAULT_WINDOW_SIZE):
+    """处理单个 chunk，使用已打开的文件对象（串行和并行都可以用）
+    按 window_size 分窗口流式读取；window_size=None 时一次读入整个 chunk"""
+    special_tokens = pretokenizer.special_tokens
+    if window_size is None or not special_tokens:
+        f.seek(start)
+        windows = [f.read() if end is None else f.read(end - start)]
+    else:
+        windows = iter_chunk_windows(f, start, end, special_tokens[0].encode("utf-8"), window_size)
+    
+    # 统计这个 chunk 的所有预分词
+    return count_windows(windows, pretokenizer)
+
+
+def process_chunk_with_mmap(mm:mmap.mmap, start, end, pretokenizer:Pretokenizer, window_size:int=DEFAULT_WINDOW_SIZE):
+    """处理单个 chunk，在整个文件的映射上按窗口取 memoryview，不需要 read 拷贝"""
+    special_tokens = pretokenizer.special_tokens
+    if not special_tokens:
+        windows = [memoryview(mm)[start:end]]
+    else:
+        windows = iter_mmap_windows(mm, start, end, special_tokens[0].encode("utf-8"), window_size)
+    return count_windows(windows, pretokenizer)
+
+
+# 按扩展名识别的压缩格式，都用标准库流式解压
+COMPRESSED_OPENERS = {".gz": gzip.open, ".xz": lzma.open, ".lzma": lzma.open, ".bz2": bz2.open}
+
+
+def is_compressed(file_path:str)->bool:
+    return os.path.splitext(file_path)[1].lower() in COMPRESSED_OPENERS
+
+
+def open_input(file_path:str)->BinaryIO:
+    """以二进制方式打开输入文件，压缩文件返回边读边解压的文件对象"""
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(file_path)[1].lower(), open)
+    return opener(file_path, "rb")
+
+
 def process_single_chunk(args):
-    """处理单个 chunk，用于并行版本（打开文件后调用 process_chunk_with_file）"""
-    file_path, start, end, special_tokens = args
+    """处理单个 chunk，用于并行版本（打开文件后调用 process_chunk_with_file）
+    use_mmap 为 True 时把整个文件映射进来，所有 worker 共享同一份 page cache
+    weight 不为 1 时每个词频都乘上这个文件的权重（见 round_weighted_counts）
+    压缩文件的 end 为 None：整个文件在这个 worker 里边解压边统计"""
+    file_path, start, end, pretokenizer, use_mmap, weight = args
     
     # 打开文件后调用统一的处理函数
-    with open(file_path, "rb") as f:
-        return process_chunk_with_file(f, start, end, special_tokens)
+    with open_input(file_path) as f:
+        if not use_mmap or end is None or start >= end:
+            counts = process_chunk_with_file(f, start, end, pretokenizer)
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                counts = process_chunk_with_mmap(mm, start, end, pretokenizer)
+    return apply_weight(counts, weight)
+
+
+def process_range_group(args):
+    """处理同一个文件里的一组字节范围（抽样时选中的若干文档或小块），文件只打开一次"""
+    file_path, ranges, pretokenizer, use_mmap, weight = args
+    counts = Counter()
+    with open_input(file_path) as f:
+        if use_mmap and not is_compressed(file_path):
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for start, end in ranges:
+                    counts.update(process_chunk_with_mmap(mm, start, end, pretokenizer))
+        else:
+            for start, end in ranges:
+                counts.update(process_chunk_with_file(f, start, end, pretokenizer))
+    return apply_weight(dict(counts), weight)
+
+
+def apply_weight(counts:dict[bytes, int], weight:float)->dict[bytes, float]:
+    """权重不为 1 时每个词频都乘上权重"""
+    if weight != 1:
+        counts = {word: count * weight for word, count in counts.items()}
+    return counts
+
+
+def count_text_window(args):
+    """统计父进程解压出来的一个窗口（已经在 special token 处切好）"""
+    window, pretokenizer, weight = args
+    return apply_weight(count_windows([window], pretokenizer), weight)
+
+
+def run_count_task(task):
+    """并行版本的一个任务是 (函数, 参数)：process_single_chunk 统计文件里的一段，count_text_window 统计一个解压出来的窗口"""
+    func, args = task
+    return func(args)
+
+
+def word_shard(word:bytes, num_shards:int)->int:
+    """按词做哈希分区。不能用内置 hash()：spawn 出来的子进程 hash 种子不同，同一个词会被分到不同的分区"""
+    return zlib.crc32(word) % num_shards
+
+
+def process_single_chunk_sharded(args):
+    """
+    并行版本的 map 阶段（分片归约）：执行一个 run_count_task 任务后按词哈希分成 num_shards 份，
+    每份写到 shard_dir 下的一个文件里，只把文件路径返回给父进程
+    """
+    task, task_id, num_shards, shard_dir = args
+    return write_count_shards(run_count_task(task), task_id, num_shards, shard_dir)
+
+
+def write_count_shards(counts:dict[bytes, int], task_id, num_shards:int, shard_dir:str)->list[str]:
+    """把一个 map 任务的计数按 word_shard 分成 num_shards 份，分别 pickle 到 shard_dir，返回每个分区的文件路径"""
+    partitions = [{} for _ in range(num_shards)]
+    for word, count in counts.items():
+        partitions[word_shard(word, num_shards)][word] = count
+
+    paths = []
+    for shard_id, partition in enumerate(partitions):
+        path = os.path.join(shard_dir, f"map{task_id}_shard{shard_id}.pkl")
+        with open(path, "wb") as f:
+            pickle.dump(partition, f, protocol=pickle.HIGHEST_PROTOCOL)
+        paths.append(path)
+    return paths
+
+
+def reduce_shard(paths:list[str])->dict[bytes, int]:
+    """reduce 阶段：把同一个分区在所有 map 任务里的部分计数加起来。不同分区之间的词互不重叠"""
+    shard_counts = Counter()
+    for path in paths:
+        with open(path, "rb") as f:
+            shard_counts.update(pickle.load(f))
+        os.remove(path)
+    return dict(shard_counts)
 
 
 @timer(name="串行处理")
-def process_serial(file_path:str)->dict[str, int]:
+def process_serial(file_path:str)->dict[bytes, int]:
 
-    special_tokens = ["<|endoftext|>"]
+    special_tokens = SPLIT_SPECIAL_TOKENS
+    pretokenizer = Pretokenizer(special_tokens)
     desired_num_chunks = multiprocessing.cpu_count()
     
     # 串行处理：使用已打开的文件对象
-    from collections import Counter
     total_counts = Counter()
     with open(file_path, "rb") as f:
-        boundaries = find_chunk_boundaries(f, desired_num_chunks, b"<|endoftext|>")
+        boundaries = find_chunk_boundaries(f, desired_num_chunks, special_tokens[0].encode("utf-8"))
         
         # 直接使用文件对象处理每个 chunk
         for start, end in zip(boundaries[:-1], boundaries[1:]):
-            result = process_chunk_with_file(f, start, end, special_tokens)
+            result = process_chunk_with_file(f, start, end, pretokenizer)
             total_counts.update(result)
     
     return total_counts
 
+def resolve_input_paths(input_paths:str|os.PathLike|list)->list[str]:
+    """
+    input_paths 可以是单个文件、glob 模式（例如 "data/shard_*.txt"），或者它们的列表。
+    glob 按文件名排序展开，返回去重后的文件列表；glob 没有匹配到任何文件时报错。
+    """
+    if isinstance(input_paths, (str, os.PathLike)):
+        input_paths = [input_paths]
+    paths = []
+    for pattern in map(os.fspath, input_paths):
+        if any(char in pattern for char in "*?["):
+            matched = sorted(glob.glob(pattern))
+            if not matched:
+                raise FileNotFoundError(f"No input files match {pattern}")
+            paths.extend(matched)
+        else:
+            paths.append(pattern)
+    return list(dict.fromkeys(paths))
+
+
+def resolve_shard_weights(file_paths:list[str], shard_weights:dict[str, float]|None)->dict[str, float]:
+    """
+    每个文件的权重。shard_weights 的 key 是文件路径或 glob 模式，按顺序取第一个匹配的；没有匹配的文件权重为 1。
+    例如 {"data/wiki_*.txt": 2.0} 让 wiki 的分片在统计里算两遍。
+    """
+    weights = {}
+    for path in file_paths:
+        weights[path] = 1
+        for pattern, weight in (shard_weights or {}).items():
+            if weight < 0:
+                raise ValueError(f"Shard weight for {pattern} must be non-negative, got {weight}")
+            if path == os.fspath(pattern) or fnmatch.fnmatch(path, os.fspath(pattern)):
+                weights[path] = weight
+                break
+    return weights
+
+
+def round_weighted_counts(counts:dict[bytes, float])->dict[bytes, int]:
+    """加权后的词频四舍五入回整数，丢掉变成 0 的词。所有权重都是 1 时不会走到这里"""
+    rounded = {}
+    for word, count in counts.items():
+        count = round(count)
+        if count > 0:
+            rounded[word] = count
+    return rounded
+
+
+def plan_byte_ranges(file_paths:list[str], chunk_size:int|None=None, min_num_chunks:int=1,
+                     use_mmap:bool=False)->list[tuple[str, int, int|None]]:
+    """
+    把一个或多个文件切成 (file_path, start, end) 的字节范围，每个范围都从 special token 处开始，可以独立统计。
+    每个文件按 chunk_size 切；min_num_chunks 按文件大小分摊到各个文件上，保证小语料也能切出足够多的任务。
+    空文件不产生任何范围。压缩文件不能 seek，整个文件是一个范围 (file_path, 0, None)。
+    """
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    split_special_token = SPLIT_SPECIAL_TOKENS[0].encode("utf-8")
+    sizes = [os.path.getsize(path) for path in file_paths]
+    total_size = sum(sizes)
+
+    ranges = []
+    for path, size in zip(file_paths, sizes):
+        if size == 0:
+            continue
+        if is_compressed(path):
+            ranges.append((path, 0, None))
+            continue
+        desired_num_chunks = max(-(-size // chunk_size), -(-min_num_chunks * size // total_size))
+        with open(path, "rb") as f:
+            if use_mmap:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    boundaries = find_chunk_boundaries_mmap(mm, desired_num_chunks, split_special_token)
+            else:
+                boundaries = find_chunk_boundaries(f, desired_num_chunks, split_special_token)
+        ranges.extend((path, start, end) for start, end in zip(boundaries[:-1], boundaries[1:]))
+    return ranges
+
+
+# 按字节范围抽样时每个抽样单位的大小（边界同样对齐到 special token，所以每个单位都是若干个完整的文档）
+DEFAULT_SAMPLE_UNIT_SIZE = 1024 * 1024
+
+
+def find_document_starts(file_path:str)->array:
+    """文件里每个文档的起始位置：0 和每个 special token 的位置（和 chunk 边界的约定一致，special token 属于后一个文档）"""
+    split_special_token = SPLIT_SPECIAL_TOKENS[0].encode("utf-8")
+    starts = array('Q', [0])
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        position = mm.find(split_special_token, 1)
+        while position != -1:
+            starts.append(position)
+            position = mm.find(split_special_token, position + len(split_special_token))
+    return starts
+
+
+def sample_byte_ranges(file_paths:list[str], sample_bytes:int, seed:int=0, documents:bool=False,
+                       unit_size:int=DEFAULT_SAMPLE_UNIT_SIZE)->tuple[list[tuple[str, int, int|None]], int, int]:
+    """
+    从 file_paths 里随机抽取一些单位，直到总大小达到 sample_bytes。同一个 seed 总是抽到同样的单位。
+    documents 为 True 时单位是 <|endoftext|> 分隔的文档，否则是 unit_size 左右、对齐到 special token 的字节范围。
+    压缩文件不能 seek，整个文件是一个单位（大小按压缩后的文件大小算）。
+    返回 (按文件和位置排好序的选中范围, 选中的单位数, 单位总数)。
+    """
+    # 每个文件的单位边界存成 array，单位用全局下标表示，文档很多时也不需要为每个文档建一个 tuple
+    file_bounds = []
+    for path in file_paths:
+        size = os.path.getsize(path)
+        if size == 0:
+            continue
+        if is_compressed(path):
+            bounds = array('Q', [0, size])
+        elif documents:
+            bounds = find_document_starts(path)
+            bounds.append(size)
+        else:
+            bounds = array('Q', [0])
+            bounds.extend(end for _, _, end in plan_byte_ranges([path], unit_size))
+        file_bounds.append((path, bounds))
+
+    unit_file = array('I')
+    unit_index = array('Q')
+    for file_id, (_, bounds) in enumerate(file_bounds):
+        unit_file.extend([file_id] * (len(bounds) - 1))
+        unit_index.extend(range(len(bounds) - 1))
+    order = array('Q', range(len(unit_file)))
+    random.Random(seed).shuffle(order)
+
+    selected = []
+    total = 0
+    for unit in order:
+        if total >= sample_bytes:
+            break
+        path, bounds = file_bounds[unit_file[unit]]
+        start, end = bounds[unit_index[unit]], bounds[unit_index[unit] + 1]
+        selected.append((path, start, None if is_compressed(path) else end))
+        total += end - start
+    selected.sort(key=lambda unit: (unit[0], unit[1]))
+    return selected, len(selected), len(order)
+
+
+def group_ranges(ranges:list[tuple[str, int, int|None]], group_size:int)->list[tuple[str, list[tuple[int, int|None]]]]:
+    """把排好序的字节范围按文件分组，每组大约 group_size 字节，作为 process_range_group 的一个任务"""
+    groups = []
+    current_path, current, current_size = None, [], 0
+    for path, start, end in ranges:
+        if current and (path != current_path or current_size >= group_size):
+            groups.append((current_path, current))
+            current, current_size = [], 0
+        current_path = path
+        current.append((start, end))
+        current_size += group_size if end is None else end - start
+    if current:
+        groups.append((current_path, current))
+    return groups
+
+
+# 并行版本的每个任务（work unit）的目标大小。任务数远多于 worker 数（over-decomposition），
+# worker 处理完一个就去领下一个，这样某个 chunk 特别大或特别慢也不会拖住整个阶段
+DEFAULT_CHUNK_SIZE = 32 * 1024 * 1024
+# 不管文件多大，任务数至少是 worker 数的这么多倍：只按 chunk_size 切的话，中等大小的文件
+# （例如 16 个 worker 的 0.5 GB）每个 worker 只分到一个任务，最慢的那个 chunk 决定整个阶段的时间
+DEFAULT_TASKS_PER_WORKER = 4
+
+
+def imap_unordered_bounded(pool, func, iterable, max_in_flight:int):
+    """
+    和 pool.imap_unordered(func, iterable, chunksize=1) 一样按完成顺序返回结果，但同一时间最多提交 max_in_flight 个任务。
+    imap_unordered 会在后台线程里一口气把 iterable 读完：输入是边解压边产生的窗口时，整个文件都会堆在内存里。
+    """
+    results = queue.SimpleQueue()
+
+    def take():
+        ok, value = results.get()
+        if not ok:
+            raise value
+        return value
+
+    in_flight = 0
+    for item in iterable:
+        if in_flight >= max_in_flight:
+            yield take()
+            in_flight -= 1
+        pool.apply_async(func, (item,), callback=lambda result: results.put((True, result)),
+                         error_callback=lambda error: results.put((False, error)))
+        in_flight += 1
+    while in_flight:
+        yield take()
+        in_flight -= 1
+
+
+def iter_stream_tasks(file_paths:list[str], pretokenizer:Pretokenizer, weights:dict[str, float], window_size:int):
+    """在父进程里依次解压 file_paths，按 window_size 切成以 special token 开头的窗口，每个窗口是一个任务"""
+    split_special_token = SPLIT_SPECIAL_TOKENS[0].encode("utf-8")
+    for path in file_paths:
+        with open_input(path) as f:
+            for window in iter_chunk_windows(f, 0, None, split_special_token, window_size):
+                yield count_text_window, (window, pretokenizer, weights[path])
+
+
 @timer(name="并行处理")
-def process_parallel(file_path:str):
-    special_tokens = ["<|endoftext|>"]
-    desired_num_chunks = multiprocessing.cpu_count()
+def process_parallel(file_path:str|list[str], num_workers:int|None=None, chunk_size:int=DEFAULT_CHUNK_SIZE,
+                     reduce_shards:int=0, use_mmap:bool=False, phase_timer:PhaseTimer|None=None,
+                     shard_weights:dict[str, float]|None=None, sample_bytes:int|None=None, sample_seed:int=0,
+                     sample_documents:bool=False, tasks_per_worker:int=DEFAULT_TASKS_PER_WORKER):
+    """
+    并行预分词。
+    file_path: 单个文件、glob 模式或它们的列表（见 resolve_input_paths）。所有文件的字节范围放进同一个任务池，
+        不需要先把分片拼成一个大文件
+    shard_weights: 按文件（路径或 glob 模式）给词频加权，见 resolve_shard_weights
+    压缩文件（.gz/.xz/.lzma/.bz2）流式解压，不需要先解压到磁盘：压缩文件不少于 num_workers 个时每个文件是一个任务，
+    由 worker 各自解压；否则由父进程依次解压，把解压出来的 chunk_size 大小的窗口分给 worker 统计
+    num_workers: 进程数，默认 cpu_count()
+    chunk_size: 每个任务的目标字节数，实际边界会对齐到下一个 special token
+    tasks_per_worker: 任务数至少是 tasks_per_worker * num_workers（文件小的时候 chunk 会比 chunk_size 小）
+    reduce_shards: 大于 0 时使用分片归约：每个 map 任务把结果按词哈希分成 reduce_shards 份写到临时目录，
+        再由 reduce_shards 个 reduce 任务并行合并各自的分区，父进程只需要拼接互不重叠的分区。
+        等于 0 时所有结果在父进程里串行合并。
+    use_mmap: 用 mmap 查找边界和读取 chunk，worker 直接在映射上解码，省掉 read 的拷贝
+    phase_timer: 如果传入，边界查找、regex 和归约的耗时会分别记到 boundary_search / regex / reduction 三个阶段
+    regex（map）和归约（reduce）的耗时分别打印出来。
+    sample_bytes: 只统计随机抽取的大约 sample_bytes 字节（见 sample_byte_ranges），用于在超大语料上快速估计；
+        sample_seed 固定抽样结果，sample_documents 为 True 时按文档抽样，否则按 1 MB 左右的字节范围抽样
+    """
+    special_tokens = SPLIT_SPECIAL_TOKENS
+    num_workers = num_workers or multiprocessing.cpu_count()
+    file_paths = resolve_input_paths(file_path)
+    weights = resolve_shard_weights(file_paths, shard_weights)
     
-    # 先获取 boundaries
-    with open(file_path, "rb") as f:
-        boundaries = find_chunk_boundaries(f, desired_num_chunks, b"<|endoftext|>")
+    phase_timer = phase_timer or PhaseTimer()
+
+    # 先获取 boundaries：至少切成 tasks_per_worker * num_workers 份；文件大的时候按 chunk_size 切成更多的小任务
+    boundary_start = time.perf_counter()
+    sampled_file_paths = [path for path in file_paths if weights[path] != 0]
+    if sample_bytes is not None:
+        sampled_ranges, num_sampled, num_units = sample_byte_ranges(sampled_file_paths, sample_bytes, sample_seed,
+                                                                    sample_documents)
+        sampled_size = sum(os.path.getsize(path) if end is None else end - start
+                           for path, start, end in sampled_ranges)
+        total_size = sum(os.path.getsize(path) for path in sampled_file_paths)
+        print(f"Sampled {num_sampled} of {num_units} {'documents' if sample_documents else 'byte ranges'}: "
+              f"{sampled_size / 1024 / 1024:.1f} MB of {total_size / 1024 / 1024:.1f} MB (seed {sample_seed})", flush=True)
+    else:
+        ranges = plan_byte_ranges(file_paths, chunk_size, min_num_chunks=tasks_per_worker * num_workers,
+                                  use_mmap=use_mmap)
+    phase_timer.add("boundary_search", time.perf_counter() - boundary_start)
     
     # 准备任务列表：传递文件路径而不是文件对象，我传文件对象出错了
+    # 预分词器只在这里构造一次，pickle 给 worker 时只传 special tokens 和正则字符串
+    pretokenizer = Pretokenizer(special_tokens)
     tasks = []
-    for start, end in zip(boundaries[:-1], boundaries[1:]):
-        tasks.append((file_path, start, end, special_tokens))
-    
-    # 并行处理
-    with multiprocessing.Pool(processes=desired_num_chunks) as pool:
-        results = pool.map(process_single_chunk, tasks)
+    stream_paths = []
+    if sample_bytes is not None:
+        # 抽中的范围按文件分组，每组不超过 chunk_size，小样本也至少分成 tasks_per_worker * num_workers 组
+        group_size = max(1, min(chunk_size, sample_bytes // (tasks_per_worker * num_workers)))
+        for path, path_ranges in group_ranges(sampled_ranges, group_size):
+            tasks.append((process_range_group, (path, path_ranges, pretokenizer, use_mmap, weights[path])))
+    else:
+        compressed_paths = [path for path in file_paths if is_compressed(path) and weights[path] != 0]
+        # 压缩文件比 worker 少时，按文件分任务会有 worker 闲着，改成父进程解压、worker 统计
+        stream_paths = compressed_paths if 0 < len(compressed_paths) < num_workers else []
+        for path, start, end in ranges:
+            if weights[path] != 0 and path not in stream_paths:
+                tasks.append((process_single_chunk, (path, start, end, pretokenizer, use_mmap, weights[path])))
+    all_tasks = itertools.chain(tasks, iter_stream_tasks(stream_paths, pretokenizer, weights, chunk_size))
+    num_processes = num_workers if stream_paths else min(num_workers, max(len(tasks), reduce_shards))
     
-    # 合并所有结果
-    from collections import Counter
     total_counts = Counter()
-    for result in results:
-        total_counts.update(result)
-    
+    reduce_time = 0.0
+    start_time = time.perf_counter()
+    with multiprocessing.Pool(processes=max(1, num_processes)) as pool:
+        if reduce_shards > 0:
+            with tempfile.TemporaryDirectory(prefix="pretokenize_shards_") as shard_dir:
+                # map：每个任务写出 reduce_shards 个分区文件
+                sharded_tasks = ((task, task_id, reduce_shards, shard_dir) for task_id, task in enumerate(all_tasks))
+                shard_paths = [[] for _ in range(reduce_shards)]
+                for paths in imap_unordered_bounded(pool, process_single_chunk_sharded, sharded_tasks, 2 * num_workers):
+                    for shard_id, path in enumerate(paths):
+                        shard_paths[shard_id].append(path)
+                map_time = time.perf_counter() - start_time
+
+                # reduce：每个分区由一个 worker 合并，分区之间的词互不重叠，父进程直接拼接
+                reduce_start = time.perf_counter()
+                for shard_counts in pool.imap_unordered(reduce_shard, shard_paths):
+                    dict.update(total_counts, shard_counts)
+                reduce_time = time.perf_counter() - reduce_start
+        else:
+            # 并行处理：按完成顺序动态领取任务，结果一到就合并，
+            # 不用等最慢的那个任务，也不用把所有结果同时留在内存里
+            for result in imap_unordered_bounded(pool, run_count_task, all_tasks, 2 * num_workers):
+                update_start = time.perf_counter()
+                total_counts.update(result)
+                reduce_time += time.perf_counter() - update_start
+            map_time = time.perf_counter() - start_time - reduce_time
+
+    phase_timer.add("regex", map_time)
+    phase_timer.add("reduction", reduce_time)
+    print(f"预分词(regex) 耗时: {map_time:.2f} 秒")
+    print(f"计数归约 耗时: {reduce_time:.2f} 秒")
+    if any(weight != 1 for weight in weights.values()):
+        return round_weighted_counts(total_counts)
     return total_counts
 
 if __name__ == "__main__":
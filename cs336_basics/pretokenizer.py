@@ -0,0 +1,77 @@
+from collections import Counter
+from collections.abc import Iterator
+
+import regex as re
+
+"""
+预分词器
+
+训练（统计预分词词频）和编码（把文本切成预分词再做 BPE）用的是同一套规则：
+1. 先在 special token 处把文本切开，special token 本身不参与预分词
+2. 每一段再用 GPT-2 的正则 PAT 切成预分词
+
+Pretokenizer 在构造时把 PAT 和 special token 的切分正则编译一次，之后每个 chunk、每次调用都直接复用。
+pickle 时只保存 special tokens 和正则字符串，发送给 worker 的代价很小，到 worker 里再编译一次。
+"""
+
+# GPT-2 的预分词正则
+PAT = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+
+
+class Pretokenizer:
+    """Compiled GPT-2 pretokenizer that splits on special tokens first."""
+
+    def __init__(self, special_tokens:list[str]|None=None, pattern:str=PAT):
+        self.special_tokens = list(special_tokens or [])
+        self.pattern = pattern
+        self._compile()
+
+    def _compile(self):
+        self._pretoken_re = re.compile(self.pattern)
+        # 长的 special token 放前面，这样一个 special token 是另一个的前缀时优先匹配长的
+        # 如果 special token 本身包含 | 等正则字符，先对每个 token 单独转义再用 | 连接
+        escaped_tokens = [re.escape(token) for token in sorted(self.special_tokens, key=len, reverse=True)]
+        self._special_re = re.compile("|".join(escaped_tokens)) if escaped_tokens else None
+
+    def __getstate__(self):
+        return {"special_tokens": self.special_tokens, "pattern": self.pattern}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+    def split_special(self, text:str)->list[str]:
+        """在 special token 处切开，丢掉 special token 本身"""
+        if self._special_re is None:
+            return [text]
+        return self._special_re.split(text)
+
+    def count(self, text:str)->Counter:
+        """训练用：统计 text 中每个预分词出现的次数"""
+        counts = Counter()
+        for segment in self.split_special(text):
+            counts.update(self._pretoken_re.findall(segment))
+        return counts
+
+    def count_bytes(self, text:str)->dict[bytes, int]:
+        """
+        训练用：和 count 一样，但 key 直接是预分词的 UTF-8 字节。
+        每个不同的预分词只编码一次（在 worker 里完成），之后训练直接用字节构建 CSR 表，不再需要 str -> bytes 的转换
+        """
+        return {word.encode("utf-8"): count for word, count in self.count(text).items()}
+
+    def iter_pretokens(self, text:str, keep_special_tokens:bool=True)->Iterator[str]:
+        """
+        编码用：按顺序产出 text 的预分词。keep_special_tokens 为 True 时 special token 会作为一个整体原样产出，
+        编码时直接映射到它的 id，不再做 BPE。
+        """
+        position = 0
+        if self._special_re is not None:
+            for match in self._special_re.finditer(text):
+                for pretoken in self._pretoken_re.finditer(text, position, match.start()):
+                    yield pretoken.group()
+                if keep_special_tokens:
+                    yield match.group()
+                position = match.end()
+        for pretoken in self._pretoken_re.finditer(text, position):
+            yield pretoken.group()
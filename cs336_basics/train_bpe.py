@@ -44,175 +44,488 @@ even faster
 
 
 """
+import os
 import sys
+import time
 import heapq
-from pretokenization_example import process_parallel
+import json
+import hashlib
+import pickle
+from array import array
+from collections import defaultdict
+from pretokenization_example import process_parallel, DEFAULT_CHUNK_SIZE, DEFAULT_TASKS_PER_WORKER
+from pretoken_table import BYTE_TOKENS, PreTokenTable
+from pretoken_cache import (cached_pretokenize, default_cache_dir, file_fingerprint, load_pre_token_counts,
+                           merge_pre_token_counts, pretoken_cache_key, save_pre_token_counts)
+from bpe_metrics import PhaseTimer, rss_mb
 
-def merge(merge_counts:int, pre_token_counts:dict[tuple[bytes], int], vocab:dict[int, bytes])->tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
-    
-    current_count = 0
-    merges = []
+# pair 打包成一个 int 作为 key：高 32 位是左 token id，低 32 位是右 token id
+# 这样 merge_tables、倒排索引和堆里都只存 int，哈希和比较的代价与 token 长度无关
+PAIR_SHIFT = 32
+PAIR_MASK = (1 << PAIR_SHIFT) - 1
+# 热点循环里直接写 (left << PAIR_SHIFT) | right，省掉一次函数调用
 
-    print(f"Initializing merge_tables with {len(pre_token_counts)} unique tokens...", file=sys.stderr, flush=True)
-    # 初始化 merge_tables：统计所有相邻对的频率（只计算一次）
-    merge_tables = {}
-    for token, count in pre_token_counts.items():
+
+def unpack_pair(key:int)->tuple[int, int]:
+    return key >> PAIR_SHIFT, key & PAIR_MASK
+
+
+# 2: 增加了 training_key
+CHECKPOINT_VERSION = 2
+
+
+def checkpoint_training_key(input_path:str|list[str]|None, shard_weights:dict[str, float]|None=None,
+                            sample_options:dict|None=None, base_counts_path:str|None=None,
+                            min_frequency:int=1)->str:
+    """
+    训练数据的身份：输入文件（和预分词缓存用同一个 key）、抽样选项、增量训练的基础词频文件和剪枝阈值。
+    存在 checkpoint 里，恢复时如果不一致就报错，避免在另一份语料的 checkpoint 上继续训练。
+    """
+    identity = {
+        "input": pretoken_cache_key(input_path, shard_weights=shard_weights, options=sample_options)
+                 if input_path else None,
+        "base_counts": file_fingerprint(base_counts_path) if base_counts_path else None,
+        "min_frequency": min_frequency,
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def save_merge_checkpoint(checkpoint_path:str, table:PreTokenTable, token_bytes:list[bytes],
+                          merges:list[tuple[int, int]], merge_tables:dict[int, int], special_tokens:list[str]|None=None,
+                          training_key:str|None=None):
+    """
+    Persist the merge state (merges so far, word table, pair counts) to checkpoint_path.
+    training_key (see checkpoint_training_key) records which data the state was trained on.
+    先写临时文件再 os.replace，保证中途崩溃时磁盘上总有一个完整的 checkpoint。
+    """
+    state = {
+        "version": CHECKPOINT_VERSION,
+        "special_tokens": special_tokens,
+        "training_key": training_key,
+        "token_bytes": token_bytes,
+        "merges": array('I', [token_id for pair in merges for token_id in pair]),
+        "symbols": table.symbols,
+        "offsets": table.offsets,
+        "lengths": table.lengths,
+        "counts": table.counts,
+        "pair_keys": array('Q', merge_tables.keys()),
+        "pair_freqs": array('Q', merge_tables.values()),
+    }
+    tmp_path = f"{checkpoint_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def load_merge_checkpoint(checkpoint_path:str)->dict:
+    """
+    Load a checkpoint written by save_merge_checkpoint.
+    返回的 dict 里 table 是 PreTokenTable，merges 是 (left_id, right_id) 列表，merge_tables 是 {pair key: 频率}
+    """
+    with open(checkpoint_path, "rb") as f:
+        state = pickle.load(f)
+    if state.get("version") != CHECKPOINT_VERSION:
+        raise ValueError(f"Unsupported BPE checkpoint version {state.get('version')} in {checkpoint_path}")
+
+    table = PreTokenTable()
+    table.symbols = state["symbols"]
+    table.offsets = state["offsets"]
+    table.lengths = state["lengths"]
+    table.counts = state["counts"]
+    flat_merges = state["merges"]
+    return {
+        "special_tokens": state["special_tokens"],
+        "training_key": state["training_key"],
+        "token_bytes": state["token_bytes"],
+        "table": table,
+        "merges": list(zip(flat_merges[::2], flat_merges[1::2])),
+        "merge_tables": dict(zip(state["pair_keys"], state["pair_freqs"])),
+    }
+
+
+def new_posting_list()->array:
+    return array('I')
+
+
+def index_word_pairs(table:PreTokenTable, count_pairs:bool=True)->tuple[dict[int, int]|None, defaultdict]:
+    """
+    统计 table 里所有相邻对的频率（count_pairs=False 时不统计，返回 None），
+    同时建立倒排索引 pair_to_words：pair key -> 包含这个 pair 的词的下标列表（array('I')）。
+
+    倒排索引是懒删除的：词不再包含某个 pair 时不会从它的列表里删掉，合并这个 pair 时再跳过；
+    词重新得到这个 pair 时会再追加一次，所以列表里可能有重复。
+    每个词下标只占 4 个字节，而 set 里每个元素要一个哈希槽加一个 int 对象，倒排索引是合并阶段最大的一块内存。
+    """
+    pair_counts = {} if count_pairs else None
+    pair_to_words = defaultdict(new_posting_list)
+    counts = table.counts
+    for word_index in range(len(table)):
+        token = table.word(word_index)
+        word_pairs = [(left << PAIR_SHIFT) | right for left, right in zip(token, token[1:])]
+        if count_pairs:
+            count = counts[word_index]
+            for key in word_pairs:
+                pair_counts[key] = pair_counts.get(key, 0) + count
+        for key in set(word_pairs):
+            pair_to_words[key].append(word_index)
+    return pair_counts, pair_to_words
+
+
+def apply_merge(table:PreTokenTable, pair_to_words:defaultdict, pair_key:int,
+                new_id:int)->tuple[dict[int, int], int]:
+    """
+    把一次合并（pair_key 合并成新 token new_id）应用到包含这个 pair 的词上，原地改写 table 并维护 pair_to_words。
+    返回 (每个 pair 的频率变化（已经乘以词频）, 改写了多少个词)。调用方负责把变化加到 merge_tables 上。
+    """
+    counts = table.counts
+    # 倒排索引里可能有重复和已经失效的词下标（见 index_word_pairs），先去重，失效的在下面跳过
+    A, B = unpack_pair(pair_key)
+    affected_words = set(pair_to_words.pop(pair_key, ()))
+
+    # 对于每个出现 (A, B) 的位置，比如 ...X A B Y...，合并后变成 ...X AB Y...
+    # 比较这个词合并前后的相邻对，把差值乘以词频累加到 merge_deltas 上
+    merge_deltas = {}
+    words_touched = 0
+    for word_index in affected_words:
+        token = table.word(word_index)
+        count = counts[word_index]
         token_len = len(token)
-        for i in range(token_len - 1):
-            # 优化：直接创建tuple，避免切片
-            char_pair = (token[i], token[i+1])
-            # 优化：使用get方法
-            merge_tables[char_pair] = merge_tables.get(char_pair, 0) + count
+
+        # 构建新token：从左到右贪心地把 (A, B) 替换成 AB
+        new_token = []
+        i = 0
+        while i < token_len:
+            if i < token_len - 1 and token[i] == A and token[i+1] == B:
+                new_token.append(new_id)
+                i += 2
+            else:
+                new_token.append(token[i])
+                i += 1
+        if len(new_token) == token_len:
+            # 失效的索引条目：这个词已经不包含要合并的 pair 了
+            continue
+        words_touched += 1
+
+        # 统计合并前后每个相邻对的数量变化
+        # 用合并后的整个新词重新统计，而不是只调整 (A, B) 两侧的邻居：同一个符号连续出现时（a a a a）
+        # 相邻的 (A, B) 会重叠，按旧词调整邻居会算错（例如把 (aa, a) 算进去），和从头重新统计的结果不一致
+        pair_deltas = {}
+        for left, right in zip(token, token[1:]):
+            key = (left << PAIR_SHIFT) | right
+            pair_deltas[key] = pair_deltas.get(key, 0) - 1
+        # 旧词里没有的 pair 才需要加进倒排索引，旧词里已有的 pair 已经在索引里了
+        new_pairs = set()
+        for left, right in zip(new_token, new_token[1:]):
+            key = (left << PAIR_SHIFT) | right
+            if key not in pair_deltas:
+                new_pairs.add(key)
+            pair_deltas[key] = pair_deltas.get(key, 0) + 1
+
+        for key, delta in pair_deltas.items():
+            if delta != 0:
+                merge_deltas[key] = merge_deltas.get(key, 0) + delta * count
+        for key in new_pairs:
+            pair_to_words[key].append(word_index)
+
+        # 在 CSR 数组里原地改写这个词
+        table.set_word(word_index, new_token)
+    return merge_deltas, words_touched
+
+
+# 懒删除的堆每次频率变化都会压入一个新条目，旧条目只有弹出时才会被丢掉。
+# 当堆的大小超过 live pair 数的这么多倍时，直接用 merge_tables 重建堆，把失效条目全部清掉
+DEFAULT_HEAP_REBUILD_RATIO = 4.0
+# pair 很少时不值得重建
+HEAP_REBUILD_MIN_SIZE = 4096
+
+
+def merge_ids(merge_counts:int, table:PreTokenTable, token_bytes:list[bytes],
+              merges:list[tuple[int, int]]|None=None, merge_tables:dict[int, int]|None=None,
+              checkpoint_path:str|None=None, checkpoint_every:int=1000,
+              special_tokens:list[str]|None=None, training_key:str|None=None,
+              merge_stats:list[tuple[int, int]]|None=None,
+              metrics_callback=None, metrics_interval:int=100,
+              heap_rebuild_ratio:float|None=DEFAULT_HEAP_REBUILD_RATIO,
+              milestones=(), milestone_callback=None, merge_workers:int=1)->list[tuple[int, int]]:
+    """
+    Integer-id BPE merge engine.
+
+    table holds the words as token id sequences and is rewritten in place; token_bytes[id] is the byte string of
+    token id (the 256 single bytes, special tokens, and every merged token so far). Each new token gets id
+    len(token_bytes) and its bytes are appended to token_bytes. Returns the merges as (left_id, right_id) pairs in
+    creation order.
+    Ties on frequency are broken exactly like the bytes-based merge (smallest (A, B) bytes pair first).
+
+    To resume from a checkpoint, pass the loaded merges and merge_tables: merge_counts is the total number of
+    merges wanted, including the ones already done. If checkpoint_path is given, the state is saved every
+    checkpoint_every merges and once more at the end (special_tokens and training_key are stored with it).
+
+    If merge_stats is a list, (frequency, runner-up frequency) of every new merge is appended to it.
+    If metrics_callback is given, it is called every metrics_interval merges with a dict of hot-path metrics
+    (see bpe_metrics).
+    The lazy heap is rebuilt from merge_tables whenever it holds more than heap_rebuild_ratio entries per live pair
+    (None disables this); the choice of the best pair does not depend on it.
+    milestone_callback(merges) is called as soon as len(merges) reaches each count in milestones, with the live
+    merges list (copy it to keep it).
+
+    merge_workers > 1 shards the words across that many worker processes (see parallel_merge). The workers rewrite
+    their words and return pair-count deltas; the priority queue and the choice of merges stay here, so the result is
+    identical to merge_workers=1.
+    """
+    merges = [] if merges is None else merges
+    milestones = set(milestones)
+    current_count = len(merges)
+
+    print(f"Initializing merge_tables with {len(table)} unique tokens...", file=sys.stderr, flush=True)
+    # 初始化 merge_tables：统计所有相邻对的频率（只计算一次）
+    # 同时建立倒排索引 pair_to_words，这样每次合并只需要访问包含该 pair 的词，而不是扫描整个 pre_token_counts
+    # 从 checkpoint 恢复时 merge_tables 已经有了，只需要重建倒排索引
+    # 多进程时词表和倒排索引都在 worker 里，这里只保留 merge_tables 和堆
+    count_pairs = merge_tables is None
+    if merge_workers > 1:
+        from parallel_merge import ShardedWordTables
+        word_tables = ShardedWordTables(table, merge_workers)
+        pair_counts = word_tables.index_pairs(count_pairs)
+        apply_pair_merge = word_tables.apply_merge
+    else:
+        word_tables = None
+        pair_counts, pair_to_words = index_word_pairs(table, count_pairs)
+        apply_pair_merge = lambda pair_key, new_id: apply_merge(table, pair_to_words, pair_key, new_id)
+    if count_pairs:
+        merge_tables = pair_counts
+
+    def sync_table():
+        # checkpoint 和结束时需要 table 是最新的
+        if word_tables is not None:
+            word_tables.gather(table)
 
     # 使用堆来维护最高频的pair，避免每次都调用max()
-    # 堆中存储 (-frequency, pair)，这样最大的frequency在堆顶
-    # 注意：使用负频率是因为heapq是最小堆
-    heap = [(-freq, pair) for pair, freq in merge_tables.items()]
-    heapq.heapify(heap)
-
-    print(f"Starting BPE merging: {merge_counts} merges needed...", file=sys.stderr, flush=True)
-    while current_count < merge_counts:
-        # 如果merge_tables为空，无法继续合并，提前退出
-        if not merge_tables:
-            break
-        
-        #第一步：从堆中获取词频最高的对
-        # 需要跳过已经被删除的pair（频率为0或不存在）
-        while heap:
-            neg_freq, char_pair_tuple = heapq.heappop(heap)
-            freq = -neg_freq
-            # 检查这个pair是否还存在且频率匹配
-            if char_pair_tuple in merge_tables and merge_tables[char_pair_tuple] == freq:
-                A, B = char_pair_tuple
-                merged_bytes = A + B
-                break
-        else:
-            # 堆空了，无法继续合并
-            break
+    # 堆中存储 (-frequency, A_bytes, B_bytes, key)，这样最大的frequency在堆顶，
+    # 频率相同时按 (A, B) 的字节序比较，和原来 (-freq, (A, B)) 的选择顺序完全一致。
+    # A_bytes/B_bytes 只是 token_bytes 里已有对象的引用，不会拼接出新的 bytes
+    def heap_entry(key:int, freq:int):
+        return (-freq, token_bytes[key >> PAIR_SHIFT], token_bytes[key & PAIR_MASK], key)
 
-        #第二步：更新vocab，添加merged_bytes到vocab中
-        vocab[len(vocab)] = merged_bytes
+    def rebuild_heap():
+        heap = [heap_entry(key, freq) for key, freq in merge_tables.items()]
+        heapq.heapify(heap)
+        return heap
 
-        #第三步：更新merges，添加(A, B)到merges中
-        merges.append((A, B))
+    heap = rebuild_heap()
+    heap_rebuilds = 0
 
-        #第四步：更新pre_token_counts和merge_tables（增量更新）
-        new_pre_token_counts = {}
-        
-        for token, count in pre_token_counts.items():
-            # 缓存token长度，避免重复调用len()
-            token_len = len(token)
-            
-            # 快速检查：如果token长度小于2，不可能包含pair
-            if token_len < 2:
-                new_pre_token_counts[token] = new_pre_token_counts.get(token, 0) + count
-                continue
-            
-            # 优化：直接比较token[i]和token[i+1]，避免创建tuple切片
-            # 检查这个token是否包含要合并的pair (A, B)
-            has_pair = False
-            for i in range(token_len - 1):
-                if token[i] == A and token[i+1] == B:
-                    has_pair = True
+    # 热点路径的计数器，用于 metrics_callback：每个区间结束时清零
+    start_time = interval_start = time.perf_counter()
+    interval_merges = interval_pops = interval_stale_pops = interval_words = 0
+
+    try:
+        print(f"Starting BPE merging: {merge_counts} merges needed...", file=sys.stderr, flush=True)
+        while current_count < merge_counts:
+            # 如果merge_tables为空，无法继续合并，提前退出
+            if not merge_tables:
+                break
+
+            #第一步：从堆中获取词频最高的对
+            # 需要跳过已经被删除的pair（频率为0或不存在）
+            while heap:
+                neg_freq, _, _, best_key = heapq.heappop(heap)
+                interval_pops += 1
+                # 检查这个pair是否还存在且频率匹配
+                if merge_tables.get(best_key) == -neg_freq:
                     break
-            
-            if not has_pair:
-                # 如果token不包含(A, B)，直接保留，不需要更新merge_tables
-                new_pre_token_counts[token] = new_pre_token_counts.get(token, 0) + count
-                continue
-            
-            # token包含(A, B)，需要更新merge_tables（三种情况）
-            # 对于每个出现 (A, B) 的位置，比如 ...X A B Y...，合并后变成 ...X AB Y...
-            # 
-            # 情况1：删除 (A, B) 本身 - 因为A和B被合并了
-            # 情况2：减少受影响的相邻对频率：
-            #   - (X, A) 需要减少，因为原来是 X-A-B，现在变成 X-AB
-            #   - (B, Y) 需要减少，因为原来是 A-B-Y，现在变成 AB-Y
-            # 情况3：增加新的相邻对频率：
-            #   - (X, AB) 需要增加（如果X存在）
-            #   - (AB, Y) 需要增加（如果Y存在）
-            
-            # 构建新token并同时更新merge_tables
-            new_token = []
-            i = 0
-            while i < token_len:
-                # 优化：直接比较，避免tuple切片
-                if i < token_len - 1 and token[i] == A and token[i+1] == B:
-                    # 找到 (A, B) 的位置
-                    # 情况1：删除 (A, B) 的频率
-                    if char_pair_tuple in merge_tables:
-                        merge_tables[char_pair_tuple] -= count
-                        if merge_tables[char_pair_tuple] <= 0:
-                            del merge_tables[char_pair_tuple]
-                        else:
-                            # 更新堆：添加新的频率
-                            heapq.heappush(heap, (-merge_tables[char_pair_tuple], char_pair_tuple))
-                    
-                    # 情况2：减少受影响的相邻对频率
-                    # 如果前面有字符X，减少 (X, A) 的频率
-                    if i > 0:
-                        X_A_pair = (token[i-1], A)
-                        if X_A_pair in merge_tables:
-                            merge_tables[X_A_pair] -= count
-                            if merge_tables[X_A_pair] <= 0:
-                                del merge_tables[X_A_pair]
-                            else:
-                                # 更新堆
-                                heapq.heappush(heap, (-merge_tables[X_A_pair], X_A_pair))
-                    
-                    # 如果后面有字符Y，减少 (B, Y) 的频率
-                    if i + 2 < token_len:
-                        B_Y_pair = (B, token[i+2])
-                        if B_Y_pair in merge_tables:
-                            merge_tables[B_Y_pair] -= count
-                            if merge_tables[B_Y_pair] <= 0:
-                                del merge_tables[B_Y_pair]
-                            else:
-                                # 更新堆
-                                heapq.heappush(heap, (-merge_tables[B_Y_pair], B_Y_pair))
-                    
-                    # 情况3：增加新的相邻对频率
-                    # 如果前面有字符X，增加 (X, AB) 的频率
-                    if i > 0:
-                        X_AB_pair = (token[i-1], merged_bytes)
-                        merge_tables[X_AB_pair] = merge_tables.get(X_AB_pair, 0) + count
-                        # 添加到堆
-                        heapq.heappush(heap, (-merge_tables[X_AB_pair], X_AB_pair))
-                    
-                    # 如果后面有字符Y，增加 (AB, Y) 的频率
-                    if i + 2 < token_len:
-                        AB_Y_pair = (merged_bytes, token[i+2])
-                        merge_tables[AB_Y_pair] = merge_tables.get(AB_Y_pair, 0) + count
-                        # 添加到堆
-                        heapq.heappush(heap, (-merge_tables[AB_Y_pair], AB_Y_pair))
-                    
-                    # 替换为合并后的token
-                    new_token.append(merged_bytes)
-                    i += 2
+                interval_stale_pops += 1
+            else:
+                # 堆空了，无法继续合并
+                break
+
+            if merge_stats is not None:
+                # 记录这次合并的频率和第二名的频率：先把堆顶已经失效的条目（以及同一个 pair 的重复条目）清掉
+                while heap and (heap[0][3] == best_key or merge_tables.get(heap[0][3]) != -heap[0][0]):
+                    heapq.heappop(heap)
+                merge_stats.append((-neg_freq, -heap[0][0] if heap else 0))
+
+            #第二步：分配新的 token id，只在这里拼接一次 bytes
+            A, B = unpack_pair(best_key)
+            new_id = len(token_bytes)
+            token_bytes.append(token_bytes[A] + token_bytes[B])
+
+            #第三步：更新merges
+            merges.append((A, B))
+
+            #第四步：只更新包含 (A, B) 的词（增量更新），把每个 pair 这次的频率变化一次性加到 merge_tables 上
+            merge_deltas, words_touched = apply_pair_merge(best_key, new_id)
+            interval_words += words_touched
+            for key, delta in merge_deltas.items():
+                if delta == 0:
+                    continue
+                freq = merge_tables.get(key, 0) + delta
+                if freq <= 0:
+                    merge_tables.pop(key, None)
                 else:
-                    new_token.append(token[i])
-                    i += 1
-            
-            new_token_tuple = tuple(new_token)
-            
-            # 更新pre_token_counts（优化：使用get方法）
-            new_pre_token_counts[new_token_tuple] = new_pre_token_counts.get(new_token_tuple, 0) + count
-        
-        # 合并相同的新token（可能有多个token合并后变成相同的）
-        pre_token_counts = new_pre_token_counts
-        
-        
-        current_count += 1
-        
-        # 进度日志：每100次合并打印一次
-        if current_count % 100 == 0 or current_count == merge_counts:
-            print(f"Progress: {current_count}/{merge_counts} merges completed ({current_count/merge_counts*100:.1f}%)", file=sys.stderr, flush=True)
+                    merge_tables[key] = freq
+                    # 更新堆：添加新的频率，旧的条目在弹出时会被跳过
+                    heapq.heappush(heap, heap_entry(key, freq))
+
+            # (A, B) 已经全部被合并
+            merge_tables.pop(best_key, None)
+
+            current_count += 1
+            interval_merges += 1
+            if milestone_callback is not None and current_count in milestones:
+                milestone_callback(merges)
+
+            # 失效条目太多时压缩堆：每个 live pair 只保留一个条目，堆顶的选择结果不变
+            if (heap_rebuild_ratio and len(heap) > HEAP_REBUILD_MIN_SIZE
+                    and len(heap) > heap_rebuild_ratio * len(merge_tables)):
+                heap = rebuild_heap()
+                heap_rebuilds += 1
 
+            if metrics_callback is not None and (current_count % metrics_interval == 0 or current_count == merge_counts):
+                now = time.perf_counter()
+                metrics_callback({
+                    "merges": current_count,
+                    "total_merges": merge_counts,
+                    "elapsed_sec": now - start_time,
+                    "merges_per_sec": interval_merges / max(now - interval_start, 1e-9),
+                    "heap_size": len(heap),
+                    "live_pairs": len(merge_tables),
+                    "heap_rebuilds": heap_rebuilds,
+                    "stale_ratio": interval_stale_pops / max(interval_pops, 1),
+                    "words_touched_per_merge": interval_words / interval_merges,
+                    "rss_mb": rss_mb(),
+                })
+                interval_start = now
+                interval_merges = interval_pops = interval_stale_pops = interval_words = 0
+
+            # 进度日志：每100次合并打印一次
+            if current_count % 100 == 0 or current_count == merge_counts:
+                print(f"Progress: {current_count}/{merge_counts} merges completed ({current_count/merge_counts*100:.1f}%)", file=sys.stderr, flush=True)
+
+            # 定期保存 checkpoint
+            if checkpoint_path and current_count % checkpoint_every == 0 and current_count != merge_counts:
+                sync_table()
+                save_merge_checkpoint(checkpoint_path, table, token_bytes, merges, merge_tables, special_tokens,
+                                      training_key)
+
+        sync_table()
+        # 结束时再保存一次，之后可以从这里继续训练到更大的 vocab_size
+        if checkpoint_path:
+            save_merge_checkpoint(checkpoint_path, table, token_bytes, merges, merge_tables, special_tokens,
+                                  training_key)
+            print(f"Saved BPE checkpoint with {len(merges)} merges to: {checkpoint_path}", file=sys.stderr, flush=True)
+    finally:
+        if word_tables is not None:
+            word_tables.close()
+
+    return merges
+
+
+def merge(merge_counts:int, pre_token_counts:dict[tuple[bytes], int], vocab:dict[int, bytes])->tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
+    """
+    bytes 接口的包装：把 pre_token_counts 转成 token id 后交给 merge_ids，最后再把结果转回 bytes。
+    vocab 的 id 必须是连续的 0..len(vocab)-1。
+    """
+    token_bytes = [vocab[i] for i in range(len(vocab))]
+    bytes_to_id = {token: token_id for token_id, token in enumerate(token_bytes)}
+    table = PreTokenTable()
+    for token, count in pre_token_counts.items():
+        table.append([bytes_to_id[symbol] for symbol in token], count)
+
+    id_merges = merge_ids(merge_counts, table, token_bytes)
+
+    # 只在输出时把 id 转回 bytes
+    for token_id in range(len(vocab), len(token_bytes)):
+        vocab[token_id] = token_bytes[token_id]
+    merges = [(token_bytes[A], token_bytes[B]) for A, B in id_merges]
     return vocab, merges
 
 
 
-def bpe_tokenizer(input_path:str,vocab_size:int,special_tokens:list[str])->tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
+def prune_pre_token_counts(pre_token_counts:dict[bytes, int], min_frequency:int)->tuple[dict[bytes, int], int]:
+    """
+    丢掉出现次数少于 min_frequency 的预分词词。
+    返回 (保留下来的词, 被丢掉的词里任意一个字节对的最大总频率)。
+    合并后的任意 pair (X, Y) 在一个词里出现的次数不会超过 X 的最后一个字节和 Y 的第一个字节组成的字节对，
+    所以第二个返回值也是任意 pair 因为剪枝最多少算的频率。
+    """
+    kept = {}
+    pruned_pair_counts = {}
+    for word, count in pre_token_counts.items():
+        if count >= min_frequency:
+            kept[word] = count
+            continue
+        for pair in zip(word, word[1:]):
+            pruned_pair_counts[pair] = pruned_pair_counts.get(pair, 0) + count
+    return kept, max(pruned_pair_counts.values(), default=0)
+
+
+def report_pruning_risk(merge_stats:list[tuple[int, int]], max_pruned_pair_freq:int):
+    """
+    估计剪枝可能改变多少个 merge：如果某次合并的频率和第二名之间的差距不超过任意 pair 最多少算的频率，
+    那么在完整的数据上第二名（或者某个被低估的 pair）就可能排到前面，这次合并以及之后的合并都可能不同。
+    一旦某次合并变了，之后的合并都在不同的状态上进行，所以从第一个有风险的合并开始，后面的全部都可能改变。
+    返回 (可能改变的 merge 数, 第一个可能改变的 merge 下标)。
+    """
+    at_risk = [index for index, (freq, runner_up) in enumerate(merge_stats) if freq - runner_up <= max_pruned_pair_freq]
+    first_at_risk = at_risk[0] if at_risk else None
+    could_change = len(merge_stats) - first_at_risk if at_risk else 0
+    print(f"Min-frequency pruning: each pair lost at most {max_pruned_pair_freq} occurrences; "
+          f"{could_change}/{len(merge_stats)} merges could change (first possible change at merge {first_at_risk}, "
+          f"{len(at_risk)} merges within the bound of their runner-up)",
+          flush=True)
+    return could_change, first_at_risk
+
+
+def compare_merges(prior_merges:list[tuple[bytes, bytes]], merges:list[tuple[bytes, bytes]],
+                   label:str="reference")->dict:
+    """
+    比较新训练的 merges 和之前的（增量训练后验证用）或完整语料上的（抽样训练用）：
+    common_prefix 是两者完全一致的前缀长度，之后的 merge 从第一个不同的地方开始都可能不同；
+    shared_merges 是两个列表共有的 merge 数（不管顺序），overlap = shared_merges / 较长列表的长度。
+    """
+    common_prefix = 0
+    for prior, new in zip(prior_merges, merges):
+        if prior != new:
+            break
+        common_prefix += 1
+    diverged = common_prefix < min(len(prior_merges), len(merges))
+    report = {
+        "prior_merges": len(prior_merges),
+        "new_merges": len(merges),
+        "common_prefix": common_prefix,
+        "shared_merges": len(set(prior_merges) & set(merges)),
+        "overlap": len(set(prior_merges) & set(merges)) / max(len(prior_merges), len(merges), 1),
+        "first_divergence": (prior_merges[common_prefix], merges[common_prefix]) if diverged else None,
+    }
+    if diverged:
+        print(f"Merges match the {label} merge list for the first {common_prefix} merges; at merge {common_prefix} "
+              f"{label} {report['first_divergence'][0]} vs new {report['first_divergence'][1]}. "
+              f"{report['shared_merges']}/{len(merges)} merges are shared (overlap {report['overlap']:.1%})", flush=True)
+    else:
+        print(f"Merges match the {label} merge list on all {common_prefix} compared merges", flush=True)
+    return report
+
+
+def ids_to_vocab_and_merges(token_bytes:list[bytes], id_merges:list[tuple[int, int]],
+                            base_vocab_size:int)->tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
+    """把 token id 形式的训练结果转成 (vocab, merges)。id_merges 可以是任意前缀，得到的就是对应大小的词表"""
+    vocab = {token_id: token_bytes[token_id] for token_id in range(base_vocab_size + len(id_merges))}
+    merges = [(token_bytes[A], token_bytes[B]) for A, B in id_merges]
+    return vocab, merges
+
+
+def bpe_tokenizer(input_path:str|list[str],vocab_size:int|list[int],special_tokens:list[str],
+                  checkpoint_path:str|None=None,checkpoint_every:int=1000,
+                  num_workers:int|None=None,chunk_size:int=DEFAULT_CHUNK_SIZE,reduce_shards:int=0,
+                  use_mmap:bool=False,cache_dir:str|None=None,min_frequency:int=1,
+                  metrics_callback=None,metrics_interval:int=100,
+                  heap_rebuild_ratio:float|None=DEFAULT_HEAP_REBUILD_RATIO,
+                  phase_timer:PhaseTimer|None=None,
+                  executor=None,shard_weights:dict[str, float]|None=None,
+                  milestone_callback=None,base_counts_path:str|None=None,save_counts_path:str|None=None,
+                  prior_merges:list[tuple[bytes, bytes]]|None=None,
+                  sample_bytes:int|None=None,sample_seed:int=0,sample_documents:bool=False,
+                  merge_workers:int=1,tasks_per_worker:int=DEFAULT_TASKS_PER_WORKER)->tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
     """
     Train a byte-level BPE tokenizer on the input text file.
     return:
@@ -220,25 +533,161 @@ def bpe_tokenizer(input_path:str,vocab_size:int,special_tokens:list[str])->tuple
     - merges: list[tuple[bytes, bytes]] A list of BPE merges produced from training. Each list item
     is a tuple of bytes (<token1>, <token2>), representing that <token1> was merged with
     <token2>. The merges should be ordered by order of creation.
+
+    checkpoint_path: if given, the merge state is saved there every checkpoint_every merges. If the file already
+    exists, training resumes from it (skipping pretokenization), so a crashed run or a run that stopped at a smaller
+    vocab_size can continue with an identical final result. A checkpoint written for other input files, shard weights,
+    sampling options, base counts or min_frequency raises ValueError instead of being reused.
+
+    num_workers / chunk_size: pretokenization worker count (default cpu_count()) and target bytes per work unit.
+    tasks_per_worker: the input is split into at least this many work units per worker, so a slow chunk does not
+    hold up the whole pretokenization phase.
+    reduce_shards: if > 0, merge the per-chunk counts with that many parallel hash-partitioned reducers.
+    use_mmap: search chunk boundaries and read chunks through a memory mapping of the input file.
+    cache_dir: directory for cached pre-token counts. Runs on the same unchanged file reuse the cached counts instead
+    of pretokenizing again. Caching is opt-in: without cache_dir or $CS336_PRETOKEN_CACHE_DIR every call pretokenizes
+    (train_tinystories_bpe enables it by default).
+    min_frequency: approximate mode for exploratory runs. Pre-tokens seen fewer than min_frequency times are dropped
+    before merging, and an estimate of how many merges could differ from the exact result is printed.
+    metrics_callback / metrics_interval: receive merge-loop metrics (merges/sec, heap size, stale-entry ratio,
+    words touched per merge, RSS) every metrics_interval merges, e.g. bpe_metrics.JsonlMetricsWriter(path).
+    heap_rebuild_ratio: compact the merge priority queue once it exceeds this many entries per live pair.
+    phase_timer: if given, accumulates per-phase wall time (boundary_search, regex, reduction, table_build,
+    merging).
+    executor: a submitit executor (see distributed_pretokenize.make_executor). If given, pretokenization runs as
+    map-reduce jobs on it instead of a local process pool; num_workers is then ignored.
+
+    input_path may also be a glob pattern (e.g. "data/shard_*.txt") or a list of files/globs. Byte ranges from all
+    files are scheduled as one work pool. shard_weights maps a file path or glob to a multiplier applied to the
+    pre-token counts of the matching files (default 1, 0 skips the file); weighted counts are rounded to integers.
+
+    vocab_size may be a list of target sizes: BPE merges are prefix-ordered, so a single run trains up to the largest
+    size and returns its (vocab, merges). milestone_callback(vocab_size, vocab, merges) is called for every target
+    as soon as training passes it (for a single int, only once at the end), e.g. to write each artifact. Time spent in
+    the callback is charged to the phase_timer's serialization phase, not to merging.
+
+    Incremental training: base_counts_path is a pre-token count file written earlier through save_counts_path (or a
+    pre-token cache file). Its counts are added to the counts of input_path, which then only needs to hold the new
+    data (None: train on the saved counts alone), and merging is re-run on the combined counts. save_counts_path
+    stores the combined counts for the next refresh. prior_merges (e.g. the merges of the previous tokenizer) are
+    compared against the new merges and the first divergence is printed (see compare_merges).
+
+    sample_bytes: train on a reproducible random sample of about that many bytes of the input instead of all of it
+    (sample_seed picks the sample; sample_documents samples <|endoftext|>-delimited documents instead of ~1 MB
+    byte ranges). Pass the merges of a full run as prior_merges to print how much of it the sample recovers.
+
+    merge_workers > 1 splits the word table across that many worker processes during merging; the merges are
+    identical to a single-process run (see parallel_merge).
     """
 
-    # 1. 初始化词汇表： 从256个字节开始; 添加special tokens 
-    vocab = {i: bytes([i]) for i in range(256)}
-    for token in special_tokens:
-        vocab[len(vocab)] = token.encode()
-    
-    # 2. pretokenize 预分词
-    pre_token_counts, _ = process_parallel(input_path) 
-    print(f"Pretokenization complete. Unique tokens: {len(pre_token_counts)}", flush=True)
-    # 将每个预分词词（字符串）转换为 bytes 序列，每个字节作为一个 token
-    print("Converting tokens to byte sequences...", flush=True)
-    pre_token_counts = {tuple(bytes([b]) for b in word.encode('utf-8')): count 
-                        for word, count in pre_token_counts.items()}
-    print(f"Conversion complete. Unique byte sequences: {len(pre_token_counts)}", flush=True)
+    phase_timer = phase_timer or PhaseTimer()
+    max_pruned_pair_freq = None
+    sample_options = ({"sample_bytes": sample_bytes, "sample_seed": sample_seed, "sample_documents": sample_documents}
+                      if sample_bytes is not None else None)
+    training_key = (checkpoint_training_key(input_path, shard_weights, sample_options, base_counts_path, min_frequency)
+                    if checkpoint_path else None)
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        # 从 checkpoint 恢复：词表、CSR 表、已完成的 merges 和 pair 频率都在里面
+        print(f"Resuming BPE training from checkpoint: {checkpoint_path}", flush=True)
+        state = load_merge_checkpoint(checkpoint_path)
+        if state["special_tokens"] != special_tokens:
+            raise ValueError(f"Checkpoint was trained with special tokens {state['special_tokens']}, got {special_tokens}")
+        if state["training_key"] != training_key:
+            raise ValueError(f"Checkpoint {checkpoint_path} was trained on different data (input files, shard weights, "
+                             f"sampling, base counts or min_frequency); delete it or use another checkpoint_path")
+        token_bytes = state["token_bytes"]
+        table = state["table"]
+        id_merges = state["merges"]
+        merge_tables = state["merge_tables"]
+        base_vocab_size = 256 + len(special_tokens)
+        print(f"Loaded {len(id_merges)} merges and {len(table)} unique byte sequences", flush=True)
+    else:
+        # 1. 初始化词汇表： 从256个字节开始; 添加special tokens 
+        token_bytes = list(BYTE_TOKENS)
+        for token in special_tokens:
+            token_bytes.append(token.encode())
+        base_vocab_size = len(token_bytes)
+        
+        # 2. pretokenize 预分词
+        # 同一个文件的预分词结果会缓存到 cache_dir，扫 vocab_size 时只有第一次需要真正预分词
+        if executor is not None and sample_bytes is not None:
+            raise ValueError("Sampling (sample_bytes) is only supported with the local process pool, not an executor")
+        if executor is not None:
+            # 只有用集群时才需要 submitit
+            from distributed_pretokenize import pretokenize_distributed
+            pretokenize = lambda path: pretokenize_distributed(path, executor, chunk_size=chunk_size,
+                                                               reduce_shards=reduce_shards, use_mmap=use_mmap,
+                                                               phase_timer=phase_timer, shard_weights=shard_weights)
+        else:
+            pretokenize = lambda path: process_parallel(path, num_workers=num_workers, chunk_size=chunk_size,
+                                                        reduce_shards=reduce_shards, use_mmap=use_mmap,
+                                                        phase_timer=phase_timer, shard_weights=shard_weights,
+                                                        sample_bytes=sample_bytes, sample_seed=sample_seed,
+                                                        sample_documents=sample_documents,
+                                                        tasks_per_worker=tasks_per_worker)[0]
+        pre_token_counts = (cached_pretokenize(input_path, cache_dir or default_cache_dir(), pretokenize,
+                                               shard_weights=shard_weights, options=sample_options) if input_path else {})
+        print(f"Pretokenization complete. Unique tokens: {len(pre_token_counts)}", flush=True)
+        if base_counts_path:
+            # 增量训练：旧语料的词频直接从文件读取，只有新增的语料需要预分词
+            pre_token_counts = merge_pre_token_counts(load_pre_token_counts(base_counts_path), pre_token_counts)
+            print(f"Added pre-token counts from {base_counts_path}. Unique tokens: {len(pre_token_counts)}", flush=True)
+        if save_counts_path:
+            save_pre_token_counts(save_counts_path, pre_token_counts)
+            print(f"Saved pre-token counts to: {save_counts_path}", flush=True)
+        if min_frequency > 1:
+            # 长尾的低频词占了 pre_token_counts 的大部分，但几乎不影响排在前面的 merges
+            pre_token_counts, max_pruned_pair_freq = prune_pre_token_counts(pre_token_counts, min_frequency)
+            print(f"Pruned pre-tokens below frequency {min_frequency}. Unique tokens: {len(pre_token_counts)}", flush=True)
+        # 预分词阶段已经直接产出 UTF-8 字节，单个字节的 id 就是字节值本身（0-255），直接拷进紧凑的 CSR 表
+        with phase_timer.phase("table_build"):
+            table = PreTokenTable.from_pre_token_counts(pre_token_counts)
+        del pre_token_counts
+        print(f"Pre-token table built. Unique byte sequences: {len(table)} ({table.nbytes() / 1024 / 1024:.1f} MB)", flush=True)
+        id_merges = []
+        merge_tables = None
 
     # 3. 合并词频最高的词对，添加到词汇表中
-    num_merges_needed = vocab_size - len(vocab)
-    vocab, merges = merge(num_merges_needed, pre_token_counts, vocab)
+    # 训练过程全部在 token id 上进行，只在最后把新 token 和 merges 转成 bytes
+    # 多个目标大小时训练到最大的那个，经过每个目标时就把前缀转成 (vocab, merges) 交给 milestone_callback
+    vocab_sizes = sorted(set(vocab_size)) if isinstance(vocab_size, (list, tuple)) else [vocab_size]
+    num_merges_needed = vocab_sizes[-1] - base_vocab_size
+    pending_milestones = {size - base_vocab_size: size for size in vocab_sizes} if milestone_callback else {}
+
+    def emit_milestone(size, id_merges_so_far):
+        # 回调一般是在保存词表，在合并过程中调用时也记到 serialization 阶段，不算在 merging 里
+        with phase_timer.phase("serialization"):
+            milestone_callback(size, *ids_to_vocab_and_merges(token_bytes, id_merges_so_far, base_vocab_size))
+
+    # checkpoint 里已经有的部分不会再经过，直接从前缀生成
+    for num_merges, size in sorted(pending_milestones.items()):
+        if num_merges <= len(id_merges) and num_merges < num_merges_needed:
+            emit_milestone(size, id_merges[:max(num_merges, 0)])
+            del pending_milestones[num_merges]
+
+    merge_stats = [] if max_pruned_pair_freq is not None else None
+    if len(id_merges) < num_merges_needed:
+        with phase_timer.phase("merging"):
+            id_merges = merge_ids(num_merges_needed, table, token_bytes, id_merges, merge_tables,
+                                  checkpoint_path=checkpoint_path, checkpoint_every=checkpoint_every,
+                                  special_tokens=special_tokens, training_key=training_key,
+                                  merge_stats=merge_stats,
+                                  metrics_callback=metrics_callback, metrics_interval=metrics_interval,
+                                  heap_rebuild_ratio=heap_rebuild_ratio,
+                                  milestones=[n for n in pending_milestones if n < num_merges_needed],
+                                  milestone_callback=lambda merges: emit_milestone(
+                                      pending_milestones.pop(len(merges)), merges),
+                                  merge_workers=merge_workers)
+    if merge_stats is not None:
+        report_pruning_risk(merge_stats[:max(num_merges_needed, 0)], max_pruned_pair_freq)
+    # checkpoint 里的 merges 可能比需要的多：BPE 的 merges 是按顺序的前缀，直接截断即可
+    id_merges = id_merges[:max(num_merges_needed, 0)]
+    vocab, merges = ids_to_vocab_and_merges(token_bytes, id_merges, base_vocab_size)
+    # 最大的目标，以及因为没有可合并的 pair 提前结束而没有经过的目标：词表就是训练到的全部
+    for num_merges, size in sorted(pending_milestones.items()):
+        emit_milestone(size, id_merges[:max(num_merges, 0)])
+    if prior_merges is not None:
+        compare_merges(prior_merges, merges)
     
     # 4. 返回词汇表和合并表
     return vocab, merges
@@ -1,12 +1,15 @@
-import time, tracemalloc
+import time
 import cProfile
 import pstats
 import json
 import os
 import psutil
+from contextlib import nullcontext
 from pathlib import Path
 from tests.common import gpt2_bytes_to_unicode
 from train_bpe import bpe_tokenizer
+from bpe_metrics import PeakRSSSampler, PhaseTimer
+from bpe_binary import save_bpe_binary
 
 
 """
@@ -30,6 +33,8 @@ def get_project_path() -> Path:
     return project_path
 
 project_path = get_project_path()
+# 训练脚本默认打开预分词缓存：同一份语料扫不同的 vocab_size 时只预分词一次
+DEFAULT_CACHE_DIR = project_path / 'data' / 'pretoken_cache'
 
 def serialize_vocab(vocab:dict[int, bytes])->dict[str, int]:
     result = {}
@@ -51,39 +56,103 @@ def serialize_merges(merges:list[tuple[bytes, bytes]])->list[str]:
         result.append(f"{str1} {str2}")  # 用空格分隔
     return result
 
-def train_tinystories_bpe(input_path:str, vocab_size:int, special_tokens:list[str], output_prefix:str|None=None)->tuple[dict[str, int], list[str]]:
+def tokenizer_file_paths(output_prefix:str|None)->dict[str, Path]:
+    """data 目录下 vocab / merges / 二进制 / 报告文件的路径，根据 output_prefix 配置文件名"""
+    data_dir = project_path / 'data'
+    data_dir.mkdir(exist_ok=True)  # 确保目录存在
+    # 如果提供了 output_prefix，使用它作为文件名前缀；否则使用默认名称
+    prefix = f'{output_prefix}_' if output_prefix else ''
+    return {
+        "vocab": data_dir / f'{prefix}vocab.json',
+        "merges": data_dir / f'{prefix}merges.txt',
+        "binary": data_dir / f'{prefix}tokenizer.bin',
+        "report": data_dir / f'{prefix}report.json',
+    }
+
+
+def save_tokenizer_files(vocab:dict[int, bytes], merges:list[tuple[bytes, bytes]],
+                         output_prefix:str|None)->tuple[dict[str, int], list[str]]:
+    """序列化并保存词汇表和合并表到磁盘（JSON + 文本 + 二进制），返回序列化后的 vocab 和 merges"""
+    paths = tokenizer_file_paths(output_prefix)
+    vocab_serialized: dict[str, int] = serialize_vocab(vocab)
+    merges_serialized = serialize_merges(merges)
+    with open(paths["vocab"], 'w', encoding='utf-8') as f:
+        json.dump(vocab_serialized, f, indent=2, ensure_ascii=False)
+    with open(paths["merges"], 'w', encoding='utf-8') as f:
+        f.write('\n'.join(merges_serialized) + '\n')
+    # 同时保存一份二进制格式，用 bpe_binary.load_bpe_binary 可以在毫秒级加载
+    save_bpe_binary(str(paths["binary"]), vocab, merges)
+
+    print(f"Saved vocab to: {paths['vocab']}")
+    print(f"Saved merges to: {paths['merges']}")
+    print(f"Saved binary vocab and merges to: {paths['binary']}")
+    return vocab_serialized, merges_serialized
+
+
+def train_tinystories_bpe(input_path:str, vocab_size:int|list[int], special_tokens:list[str], output_prefix:str|None=None,
+                          checkpoint_path:str|None=None, checkpoint_every:int=1000,
+                          instrument:bool=False, profile:bool=False,
+                          cache_dir:str|None=str(DEFAULT_CACHE_DIR))->tuple[dict[str, int], list[str]]:
+    """
+    cache_dir: 预分词结果的缓存目录（默认 data/pretoken_cache），同一个文件再次训练（例如换一个 vocab_size）时
+        直接读缓存，不用重新预分词；None 时不使用缓存（除非设置了 $CS336_PRETOKEN_CACHE_DIR）
+    instrument: 记录每个阶段的耗时（boundary_search, regex, reduction, table_build, merging, serialization），
+        用后台线程采样得到真正的峰值内存，并把结果写成 JSON 报告放在 vocab 文件旁边
+    profile: 用 cProfile 跑整个训练（会让合并循环明显变慢，只在需要看调用栈时打开）
+    vocab_size 是列表时只训练一次（到最大的那个），每经过一个目标大小就把那个大小的词表保存到
+        {output_prefix}_{vocab_size}_vocab.json 等文件；最大的那个在训练结束时按同样的命名保存一次（报告也放在那里）
+    """
+    milestone_callback = None
+    if isinstance(vocab_size, (list, tuple)):
+        sweep_prefix = f"{output_prefix}_" if output_prefix else ""
+        largest_size = max(vocab_size)
+
+        def milestone_callback(size, vocab, merges):
+            # 最大的那个就是最终结果，下面统一保存，这里不重复写
+            if size != largest_size:
+                save_tokenizer_files(vocab, merges, f"{sweep_prefix}{size}")
+
+        output_prefix = f"{sweep_prefix}{largest_size}"
     
-    pr = cProfile.Profile()
-    pr.enable()
+    pr = None
+    if profile:
+        pr = cProfile.Profile()
+        pr.enable()
     start_time = time.time()
+    phase_timer = PhaseTimer()
     
     # 使用psutil测量进程内存（更准确）
     process = psutil.Process(os.getpid())
     memory_before = process.memory_info().rss / 1024 / 1024  # MB
-    peak_memory = memory_before
     
-    vocab, merges = bpe_tokenizer(input_path, vocab_size, special_tokens)
+    # 传入 checkpoint_path 后训练会定期保存状态，崩溃或提前停止后再次运行会从 checkpoint 继续
+    # 只读开始和结束两次 RSS 会漏掉中间的峰值，instrument 模式下用后台线程持续采样（包括预分词的子进程）
+    with (PeakRSSSampler() if instrument else nullcontext()) as sampler:
+        vocab, merges = bpe_tokenizer(input_path, vocab_size, special_tokens,
+                                      checkpoint_path=checkpoint_path, checkpoint_every=checkpoint_every,
+                                      phase_timer=phase_timer, milestone_callback=milestone_callback,
+                                      cache_dir=cache_dir)
     
-    # 获取峰值内存
     memory_after = process.memory_info().rss / 1024 / 1024  # MB
-    peak_memory = max(peak_memory, memory_after)
+    peak_memory = sampler.peak_mb if sampler else max(memory_before, memory_after)
 
-    pr.disable()
-    s = pstats.Stats(pr)
-    
-    # 性能分析输出 - 按累计时间排序（显示调用链）
-    print("\n" + "="*80)
-    print("Performance Profile (sorted by cumulative time - shows call chains)")
-    print("="*80)
-    s.sort_stats('cumulative')
-    s.print_stats(20)  # 打印前20个函数
-    
-    # 性能分析输出 - 按自身时间排序（显示最耗时的函数本身）
-    print("\n" + "="*80)
-    print("Performance Profile (sorted by internal time - shows most time-consuming functions)")
-    print("="*80)
-    s.sort_stats('time')
-    s.print_stats(20)  # 打印前20个函数
+    if pr is not None:
+        pr.disable()
+        s = pstats.Stats(pr)
+        
+        # 性能分析输出 - 按累计时间排序（显示调用链）
+        print("\n" + "="*80)
+        print("Performance Profile (sorted by cumulative time - shows call chains)")
+        print("="*80)
+        s.sort_stats('cumulative')
+        s.print_stats(20)  # 打印前20个函数
+        
+        # 性能分析输出 - 按自身时间排序（显示最耗时的函数本身）
+        print("\n" + "="*80)
+        print("Performance Profile (sorted by internal time - shows most time-consuming functions)")
+        print("="*80)
+        s.sort_stats('time')
+        s.print_stats(20)  # 打印前20个函数
 
     end_time = time.time()
     elapsed_seconds = end_time - start_time
@@ -102,32 +171,33 @@ def train_tinystories_bpe(input_path:str, vocab_size:int, special_tokens:list[st
         print(f"Time taken: {minutes} minute(s), {seconds:.2f} seconds ({elapsed_seconds:.2f} seconds total)")
     else:
         print(f"Time taken: {seconds:.2f} seconds")
-    print(f"Memory usage: {memory_after:.2f} MB (peak: {peak_memory:.2f} MB)")
+    print(f"Memory usage: {memory_after:.2f} MB (peak: {peak_memory:.2f} MB{'' if instrument else ', start/end only'})")
+    if instrument:
+        for phase_name, phase_seconds in phase_timer.seconds.items():
+            print(f"  {phase_name}: {phase_seconds:.2f} seconds")
     print("="*80 + "\n")  
 
-    # 序列化并保存词汇表和合并表到磁盘
-    vocab_serialized: dict[str, int] = serialize_vocab(vocab)
-    merges_serialized = serialize_merges(merges)
-    
     # 保存到 data 目录，根据 output_prefix 配置文件名
-    data_dir = project_path / 'data'
-    data_dir.mkdir(exist_ok=True)  # 确保目录存在
-    
-    # 如果提供了 output_prefix，使用它作为文件名前缀；否则使用默认名称
-    if output_prefix:
-        vocab_path = data_dir / f'{output_prefix}_vocab.json'
-        merges_path = data_dir / f'{output_prefix}_merges.txt'
-    else:
-        vocab_path = data_dir / 'vocab.json'
-        merges_path = data_dir / 'merges.txt'
-    
-    with open(vocab_path, 'w', encoding='utf-8') as f:
-        json.dump(vocab_serialized, f, indent=2, ensure_ascii=False)
-    with open(merges_path, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(merges_serialized) + '\n')
-    
-    print(f"Saved vocab to: {vocab_path}")
-    print(f"Saved merges to: {merges_path}")
+    report_path = tokenizer_file_paths(output_prefix)["report"]
+    with phase_timer.phase("serialization"):
+        vocab_serialized, merges_serialized = save_tokenizer_files(vocab, merges, output_prefix)
+
+    if instrument:
+        # 机器可读的报告，和 vocab 放在一起
+        report = {
+            "input_path": str(input_path),
+            "vocab_size": vocab_size,
+            "num_merges": len(merges),
+            "training_seconds": elapsed_seconds,
+            "phases": phase_timer.seconds,
+            "memory_before_mb": memory_before,
+            "memory_after_mb": memory_after,
+            "peak_rss_mb": peak_memory,
+            "cprofile": profile,
+        }
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved training report to: {report_path}")
 
     # 找出最长的token
     longest_token = max(vocab_serialized.keys(), key=len)
@@ -162,4 +232,6 @@ def train_tinystories_bpe(input_path:str, vocab_size:int, special_tokens:list[st
 
 if __name__ == "__main__":
     input_file = project_path / 'data' / 'TinyStoriesV2-GPT4-train.txt'
-    vocab, merges = train_tinystories_bpe(str(input_file), 10000, ["<|endoftext|>"], output_prefix="tinystories-train")
+    checkpoint_file = project_path / 'data' / 'tinystories-train_bpe_checkpoint.pkl'
+    vocab, merges = train_tinystories_bpe(str(input_file), 10000, ["<|endoftext|>"], output_prefix="tinystories-train",
+                                          checkpoint_path=str(checkpoint_file), instrument=True)
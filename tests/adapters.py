@@ -591,6 +591,8 @@ def run_train_bpe(
     """
     from cs336_basics.train_bpe import bpe_tokenizer
     
-    vocab, merges = bpe_tokenizer(str(input_path), vocab_size, special_tokens)
+    if isinstance(input_path, (str, os.PathLike)):
+        input_path = str(input_path)
+    vocab, merges = bpe_tokenizer(input_path, vocab_size, special_tokens, **kwargs)
     return vocab, merges
 
@@ -1,6 +1,8 @@
 import json
 import time
 
+import pytest
+
 from .adapters import run_train_bpe
 from .common import FIXTURES_PATH, gpt2_bytes_to_unicode
 
@@ -86,3 +88,556 @@ def test_train_bpe_special_tokens(snapshot):
             "merges": merges,
         },
     )
+
+
+def test_train_bpe_resume_from_checkpoint(tmp_path):
+    """
+    Training to a smaller vocab with a checkpoint and then continuing to a larger
+    vocab from that checkpoint should give exactly the same result as one run.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    checkpoint_path = tmp_path / "bpe_checkpoint.pkl"
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+    )
+    run_train_bpe(
+        input_path=input_path,
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=str(checkpoint_path),
+        checkpoint_every=50,
+    )
+    resumed_vocab, resumed_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=str(checkpoint_path),
+    )
+    assert resumed_merges == merges
+    assert resumed_vocab == vocab
+
+
+def test_train_bpe_pretoken_cache(tmp_path):
+    """
+    A second run on the same file should reuse the cached pre-token counts
+    and still give exactly the same result.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    cache_dir = tmp_path / "pretoken_cache"
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        cache_dir=str(cache_dir),
+    )
+    assert len(list(cache_dir.glob("*.ptc"))) == 1
+    cached_vocab, cached_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        cache_dir=str(cache_dir),
+    )
+    assert cached_merges == merges
+    assert cached_vocab == vocab
+
+
+def test_bpe_binary_roundtrip(tmp_path):
+    from cs336_basics.bpe_binary import load_bpe_binary, save_bpe_binary
+
+    vocab, merges = run_train_bpe(
+        input_path=FIXTURES_PATH / "corpus.en",
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+    )
+    binary_path = tmp_path / "tokenizer.bin"
+    save_bpe_binary(str(binary_path), vocab, merges)
+    loaded_vocab, loaded_merges = load_bpe_binary(str(binary_path))
+    assert loaded_vocab == vocab
+    assert loaded_merges == merges
+
+
+def test_train_bpe_submitit_executor(tmp_path):
+    """
+    Pretokenizing through submitit map-reduce jobs on the local executor
+    should give exactly the same result as the local process pool.
+    """
+    from cs336_basics.distributed_pretokenize import make_executor
+
+    input_path = FIXTURES_PATH / "corpus.en"
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+    )
+    executor = make_executor(str(tmp_path / "submitit"), cluster="local", timeout_min=10)
+    distributed_vocab, distributed_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        executor=executor,
+        reduce_shards=2,
+    )
+    assert distributed_merges == merges
+    assert distributed_vocab == vocab
+
+
+def test_train_bpe_sharded_input(tmp_path):
+    """
+    Training on a glob of shard files should match training on the concatenated
+    file, and a shard weight of 2 should match listing that shard twice.
+    """
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    text = input_path.read_text(encoding="utf-8")
+    documents = text.split("<|endoftext|>")
+    shards = [documents[0:2], documents[2:4], documents[4:]]
+    for i, shard in enumerate(shards):
+        content = "<|endoftext|>".join(shard)
+        if i < len(shards) - 1:
+            content += "<|endoftext|>"
+        (tmp_path / f"shard_{i}.txt").write_text(content, encoding="utf-8")
+    (tmp_path / "shard_0_copy.txt").write_text((tmp_path / "shard_0.txt").read_text(encoding="utf-8"), encoding="utf-8")
+
+    vocab, merges = run_train_bpe(input_path=input_path, vocab_size=300, special_tokens=["<|endoftext|>"])
+    sharded_vocab, sharded_merges = run_train_bpe(
+        input_path=str(tmp_path / "shard_[0-9].txt"),
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+    )
+    assert sharded_merges == merges
+    assert sharded_vocab == vocab
+
+    _, weighted_merges = run_train_bpe(
+        input_path=str(tmp_path / "shard_[0-9].txt"),
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+        shard_weights={str(tmp_path / "shard_0.txt"): 2},
+    )
+    _, duplicated_merges = run_train_bpe(
+        input_path=[str(tmp_path / "shard_[0-9].txt"), str(tmp_path / "shard_0_copy.txt")],
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+    )
+    assert weighted_merges == duplicated_merges
+
+
+def test_train_bpe_compressed_input(tmp_path):
+    """
+    Training on a gzip-compressed copy of the corpus should give exactly the
+    same result as training on the uncompressed file.
+    """
+    import gzip
+
+    input_path = FIXTURES_PATH / "corpus.en"
+    compressed_path = tmp_path / "corpus.en.gz"
+    with gzip.open(compressed_path, "wb") as f:
+        f.write(input_path.read_bytes())
+    vocab, merges = run_train_bpe(input_path=input_path, vocab_size=500, special_tokens=["<|endoftext|>"])
+    compressed_vocab, compressed_merges = run_train_bpe(
+        input_path=compressed_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+    )
+    assert compressed_merges == merges
+    assert compressed_vocab == vocab
+
+
+def test_train_bpe_vocab_sweep():
+    """
+    One run with several target vocab sizes should emit, at each milestone,
+    exactly what a separate run to that size returns.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    milestones = {}
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=[300, 500, 400],
+        special_tokens=["<|endoftext|>"],
+        milestone_callback=lambda size, vocab, merges: milestones.__setitem__(size, (vocab, merges)),
+    )
+    assert sorted(milestones) == [300, 400, 500]
+    assert milestones[500] == (vocab, merges)
+    for size in (300, 400):
+        assert milestones[size] == run_train_bpe(input_path=input_path, vocab_size=size, special_tokens=["<|endoftext|>"])
+
+
+def test_train_bpe_milestone_timed_as_serialization():
+    """Time spent in milestone_callback during merging goes to serialization, not merging."""
+    from cs336_basics.bpe_metrics import PhaseTimer
+
+    phase_timer = PhaseTimer()
+    run_train_bpe(
+        input_path=FIXTURES_PATH / "corpus.en",
+        vocab_size=[300, 400, 500],
+        special_tokens=["<|endoftext|>"],
+        phase_timer=phase_timer,
+        milestone_callback=lambda size, vocab, merges: time.sleep(0.5),
+    )
+    assert phase_timer.seconds["serialization"] >= 1.5
+    assert phase_timer.seconds["merging"] < 1.0
+
+
+def test_train_bpe_incremental(tmp_path):
+    """
+    Training on the saved counts of one part of the corpus plus the other part
+    as a delta should match training on the whole corpus at once.
+    """
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    documents = input_path.read_text(encoding="utf-8").split("<|endoftext|>")
+    base_path, delta_path = tmp_path / "base.txt", tmp_path / "delta.txt"
+    base_path.write_text("<|endoftext|>".join(documents[:3]) + "<|endoftext|>", encoding="utf-8")
+    delta_path.write_text("<|endoftext|>".join(documents[3:]), encoding="utf-8")
+    counts_path = tmp_path / "base_counts.ptc"
+
+    _, base_merges = run_train_bpe(
+        input_path=base_path,
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+        save_counts_path=str(counts_path),
+    )
+    vocab, merges = run_train_bpe(input_path=input_path, vocab_size=300, special_tokens=["<|endoftext|>"])
+    incremental_vocab, incremental_merges = run_train_bpe(
+        input_path=delta_path,
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+        base_counts_path=str(counts_path),
+        prior_merges=base_merges,
+    )
+    assert incremental_merges == merges
+    assert incremental_vocab == vocab
+
+
+def test_train_bpe_document_sampling():
+    """
+    Document sampling is reproducible for a fixed seed, and a sample at least as
+    large as the corpus gives exactly the full-corpus result.
+    """
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    vocab, merges = run_train_bpe(input_path=input_path, vocab_size=300, special_tokens=["<|endoftext|>"])
+    sampled = [
+        run_train_bpe(
+            input_path=input_path,
+            vocab_size=300,
+            special_tokens=["<|endoftext|>"],
+            sample_bytes=1500,
+            sample_seed=1,
+            sample_documents=True,
+            prior_merges=merges,
+        )
+        for _ in range(2)
+    ]
+    assert sampled[0] == sampled[1]
+    full_sample = run_train_bpe(
+        input_path=input_path,
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+        sample_bytes=input_path.stat().st_size,
+        sample_documents=True,
+    )
+    assert full_sample == (vocab, merges)
+
+
+def test_train_bpe_parallel_merge(tmp_path):
+    """
+    Merging with the word table sharded across worker processes should give
+    exactly the single-process result, including the saved checkpoint.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    vocab, merges = run_train_bpe(input_path=input_path, vocab_size=500, special_tokens=["<|endoftext|>"])
+    checkpoint_path = tmp_path / "checkpoint.pkl"
+    parallel_vocab, parallel_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        merge_workers=3,
+        checkpoint_path=str(checkpoint_path),
+        checkpoint_every=100,
+    )
+    assert parallel_merges == merges
+    assert parallel_vocab == vocab
+
+    # Continuing from that checkpoint to a larger vocab matches a direct run
+    resumed_vocab, resumed_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=600,
+        special_tokens=["<|endoftext|>"],
+        merge_workers=2,
+        checkpoint_path=str(checkpoint_path),
+    )
+    assert (resumed_vocab, resumed_merges) == run_train_bpe(
+        input_path=input_path, vocab_size=600, special_tokens=["<|endoftext|>"]
+    )
+
+
+def naive_bpe_merges(pre_token_counts: dict[tuple[bytes, ...], int], num_merges: int) -> list[tuple[bytes, bytes]]:
+    """
+    Reference BPE that recounts every pair from scratch before each merge.
+    Ties are broken like the trainer (smallest (A, B) bytes pair first).
+    """
+    words = dict(pre_token_counts)
+    merges = []
+    for _ in range(num_merges):
+        pair_counts = {}
+        for word, count in words.items():
+            for pair in zip(word, word[1:]):
+                pair_counts[pair] = pair_counts.get(pair, 0) + count
+        if not pair_counts:
+            break
+        (left, right), _ = min(pair_counts.items(), key=lambda item: (-item[1], item[0]))
+        merges.append((left, right))
+        merged_words = {}
+        for word, count in words.items():
+            merged, i = [], 0
+            while i < len(word):
+                if i + 1 < len(word) and word[i] == left and word[i + 1] == right:
+                    merged.append(left + right)
+                    i += 2
+                else:
+                    merged.append(word[i])
+                    i += 1
+            merged_words[tuple(merged)] = merged_words.get(tuple(merged), 0) + count
+        words = merged_words
+    return merges
+
+
+def test_merge_repeated_symbols_matches_naive():
+    """
+    Runs of one repeated symbol ("aaaa") contain overlapping occurrences of the
+    same pair; the incremental pair counts must still match a full recount.
+    """
+    from cs336_basics.train_bpe import merge
+
+    cases = [
+        {b"aaaa": 1},
+        {b"aaaaa": 2, b"aaaa": 1, b"baaa": 3},
+        {b"aaaaaaa": 5, b"abab": 2, b"ababab": 1, b"aab": 4},
+    ]
+    for case in cases:
+        pre_token_counts = {tuple(bytes([b]) for b in word): count for word, count in case.items()}
+        vocab = {i: bytes([i]) for i in range(256)}
+        _, merges = merge(10, dict(pre_token_counts), vocab)
+        assert merges == naive_bpe_merges(pre_token_counts, 10)
+    assert merge(3, {(b"a",) * 4: 1}, {i: bytes([i]) for i in range(256)})[1] == [(b"a", b"a"), (b"aa", b"aa")]
+
+
+def test_train_bpe_checkpoint_rejects_other_data(tmp_path):
+    """
+    A checkpoint must not be resumed on a different corpus or with a
+    different min_frequency.
+    """
+    checkpoint_path = tmp_path / "bpe_checkpoint.pkl"
+    run_train_bpe(
+        input_path=FIXTURES_PATH / "corpus.en",
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=str(checkpoint_path),
+    )
+    with pytest.raises(ValueError, match="different data"):
+        run_train_bpe(
+            input_path=FIXTURES_PATH / "tinystories_sample.txt",
+            vocab_size=400,
+            special_tokens=["<|endoftext|>"],
+            checkpoint_path=str(checkpoint_path),
+        )
+    with pytest.raises(ValueError, match="different data"):
+        run_train_bpe(
+            input_path=FIXTURES_PATH / "corpus.en",
+            vocab_size=400,
+            special_tokens=["<|endoftext|>"],
+            checkpoint_path=str(checkpoint_path),
+            min_frequency=2,
+        )
+
+
+def write_mixed_corpus(path):
+    """TinyStories documents plus multi-byte characters, odd whitespace and invalid UTF-8."""
+    stories = (FIXTURES_PATH / "tinystories_sample.txt").read_bytes()[:20000]
+    extra = "café 日本語　x\xa0y  \t\n\n it's 123!!".encode() + b" \xff\xfe bro\xc3ken \xe6\x97"
+    path.write_bytes(extra + stories + b"<|endoftext|>" + extra * 20 + b"<|endoftext|>" + extra)
+    return path
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+@pytest.mark.parametrize("reduce_shards", [0, 3])
+def test_parallel_pretokenization_matches_serial(tmp_path, use_mmap, reduce_shards):
+    from cs336_basics.pretokenization_example import process_parallel, process_serial
+
+    input_path = str(write_mixed_corpus(tmp_path / "mixed.txt"))
+    expected, _ = process_serial(input_path)
+    counts, _ = process_parallel(
+        input_path, num_workers=2, chunk_size=1024, use_mmap=use_mmap, reduce_shards=reduce_shards
+    )
+    assert dict(counts) == dict(expected)
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+@pytest.mark.parametrize("window_size", [1, 7, 64, 4096])
+def test_windowed_pretokenization_matches_serial(tmp_path, use_mmap, window_size):
+    """Tiny windows force both the delimiter cuts and the bounded-carry cuts."""
+    import mmap
+
+    from cs336_basics.pretokenization_example import (
+        SPLIT_SPECIAL_TOKENS,
+        process_chunk_with_file,
+        process_chunk_with_mmap,
+        process_serial,
+    )
+    from cs336_basics.pretokenizer import Pretokenizer
+
+    input_path = write_mixed_corpus(tmp_path / "mixed.txt")
+    expected, _ = process_serial(str(input_path))
+    pretokenizer = Pretokenizer(SPLIT_SPECIAL_TOKENS)
+    size = input_path.stat().st_size
+    with open(input_path, "rb") as f:
+        if use_mmap:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                counts = process_chunk_with_mmap(mm, 0, size, pretokenizer, window_size)
+        else:
+            counts = process_chunk_with_file(f, 0, size, pretokenizer, window_size)
+    assert dict(counts) == dict(expected)
+
+
+def test_train_bpe_min_frequency_risk_report(capsys):
+    """
+    Pruning rare pre-tokens drops them before merging, and the printed risk
+    report bounds how many merges could differ from the exact result.
+    """
+    from cs336_basics.train_bpe import prune_pre_token_counts, report_pruning_risk
+
+    kept, max_pruned_pair_freq = prune_pre_token_counts({b"the": 5, b"tho": 1, b"oh": 1, b"ho": 1}, 2)
+    assert kept == {b"the": 5}
+    # (h, o) is lost once from "tho" and once from "ho"
+    assert max_pruned_pair_freq == 2
+    # once the first merge can flip, every later merge can change too
+    assert report_pruning_risk([(10, 9), (10, 5), (4, 2)], max_pruned_pair_freq) == (3, 0)
+    assert report_pruning_risk([(10, 5), (10, 9), (4, 1)], max_pruned_pair_freq) == (2, 1)
+    assert report_pruning_risk([(10, 5), (10, 7)], max_pruned_pair_freq) == (0, None)
+
+    input_path = FIXTURES_PATH / "corpus.en"
+    _, exact_merges = run_train_bpe(input_path=input_path, vocab_size=400, special_tokens=["<|endoftext|>"])
+    capsys.readouterr()
+    vocab, merges = run_train_bpe(
+        input_path=input_path, vocab_size=400, special_tokens=["<|endoftext|>"], min_frequency=2
+    )
+    assert len(vocab) == 400
+    assert merges[0] == exact_merges[0]
+    assert "Min-frequency pruning" in capsys.readouterr().out
+
+
+def test_train_bpe_metrics_callback():
+    """metrics_callback gets one record per metrics_interval merges with every documented field."""
+    records = []
+    _, merges = run_train_bpe(
+        input_path=FIXTURES_PATH / "corpus.en",
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        metrics_callback=records.append,
+        metrics_interval=50,
+    )
+    assert [record["merges"] for record in records] == [50, 100, 150, 200, len(merges)]
+    for record in records:
+        assert set(record) == {
+            "merges", "total_merges", "elapsed_sec", "merges_per_sec", "heap_size", "live_pairs",
+            "heap_rebuilds", "stale_ratio", "words_touched_per_merge", "rss_mb",
+        }
+        assert record["total_merges"] == len(merges)
+        assert record["heap_size"] >= record["live_pairs"] > 0
+        assert 0 <= record["stale_ratio"] <= 1
+        assert record["words_touched_per_merge"] > 0
+
+
+def test_train_bpe_heap_compaction():
+    """Compacting the heap aggressively must fire and must not change the merges."""
+    records = []
+    input_path = FIXTURES_PATH / "corpus.en"
+    vocab, merges = run_train_bpe(input_path=input_path, vocab_size=500, special_tokens=["<|endoftext|>"])
+    compacted_vocab, compacted_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        heap_rebuild_ratio=1.01,
+        metrics_callback=records.append,
+    )
+    assert records[-1]["heap_rebuilds"] > 0
+    assert (compacted_vocab, compacted_merges) == (vocab, merges)
+
+
+def test_pretokenizer_iter_pretokens():
+    """
+    The encoding iterator must agree with split-then-findall used for training,
+    and overlapping special tokens must come out whole (longest first).
+    """
+    import regex as re
+
+    from cs336_basics.pretokenizer import PAT, Pretokenizer
+
+    special_tokens = ["<|endoftext|>", "<|endoftext|><|endoftext|>"]
+    pretokenizer = Pretokenizer(special_tokens)
+    text = (
+        "Hello<|endoftext|><|endoftext|> world  \n<|endoftext|>it's 42 cafés!!  "
+        "<|endoftext|>\t\n\nend   <|endoftext|><|endoftext|><|endoftext|>"
+    )
+
+    expected = [pretoken for segment in pretokenizer.split_special(text) for pretoken in re.findall(PAT, segment)]
+    assert list(pretokenizer.iter_pretokens(text, keep_special_tokens=False)) == expected
+
+    with_special = list(pretokenizer.iter_pretokens(text))
+    assert [pretoken for pretoken in with_special if pretoken not in special_tokens] == expected
+    assert [pretoken for pretoken in with_special if pretoken in special_tokens] == [
+        "<|endoftext|><|endoftext|>",
+        "<|endoftext|>",
+        "<|endoftext|>",
+        "<|endoftext|><|endoftext|>",
+        "<|endoftext|>",
+    ]
+    assert "".join(with_special) == text
+    assert list(Pretokenizer().iter_pretokens("no specials  here")) == re.findall(PAT, "no specials  here")
+
+
+def make_benchmark_run(pretokenize_seconds, merges_per_sec, peak_rss_mb):
+    """A hand-built bpe_benchmark run with one pretokenize and one merge stage."""
+    return {
+        "results": [
+            {"stage": "pretokenize", "corpus": "c", "seconds": pretokenize_seconds,
+             "mb_per_sec": 8 / pretokenize_seconds, "peak_rss_mb": 100.0},
+            {"stage": "merge", "corpus": "c", "vocab_size": 1000, "seconds": 1000 / merges_per_sec,
+             "merges_per_sec": merges_per_sec, "peak_rss_mb": peak_rss_mb},
+        ]
+    }
+
+
+def test_benchmark_find_regressions():
+    """Regressions beyond the threshold are reported; stages faster than min_seconds are not compared."""
+    from cs336_basics.bpe_benchmark import find_regressions, too_short_to_compare
+
+    baseline = make_benchmark_run(pretokenize_seconds=2.0, merges_per_sec=500, peak_rss_mb=50.0)
+    assert find_regressions(make_benchmark_run(2.1, 480, 52.0), baseline, threshold=0.1) == []
+
+    regressions = find_regressions(make_benchmark_run(2.5, 400, 60.0), baseline, threshold=0.1)
+    assert len(regressions) == 3
+    assert regressions[0].startswith("pretokenize/c: mb_per_sec")
+    assert regressions[1].startswith("merge/c/1000: merges_per_sec")
+    assert regressions[2].startswith("merge/c/1000: peak_rss_mb")
+
+    # a stage that is too short in either run is skipped, however much it moved
+    short_baseline = make_benchmark_run(pretokenize_seconds=0.01, merges_per_sec=500, peak_rss_mb=50.0)
+    run = make_benchmark_run(0.05, 500, 50.0)
+    assert too_short_to_compare(run, short_baseline, min_seconds=1.0) == ["pretokenize/c"]
+    assert find_regressions(run, short_baseline, threshold=0.1, min_seconds=1.0) == []
+    assert len(find_regressions(run, short_baseline, threshold=0.1, min_seconds=0)) == 1
+
+    # stages missing from the baseline are ignored
+    assert find_regressions(make_benchmark_run(2.5, 400, 60.0), {"results": []}) == []
+
+
+def test_benchmark_append_history(tmp_path):
+    """append_history creates the history file and appends one run per call."""
+    from cs336_basics.bpe_benchmark import append_history
+
+    history_path = tmp_path / "history.json"
+    first = make_benchmark_run(2.0, 500, 50.0)
+    second = make_benchmark_run(2.1, 480, 52.0)
+    append_history(history_path, first)
+    append_history(history_path, second)
+    assert json.loads(history_path.read_text(encoding="utf-8")) == [first, second]